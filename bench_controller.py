@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+#
+# throughput benchmark for test5.0.py's control loop
+#
+# runs controller.loop() headless (miro_sim) in each behaviour mode and
+# reports ticks per second, memory per tick and publishes per tick.
+#
+#   python3 bench_controller.py --save      # record bench_baseline.json
+#   python3 bench_controller.py             # compare, exit 1 on regression
+#   python3 bench_controller.py idle dance  # only some modes
+
+import os
+import sys
+import json
+import argparse
+import tracemalloc
+import contextlib
+
+from miro_sim import Simulation, DEFAULT_SCRIPT
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_BASELINE = os.path.join(HERE, "bench_baseline.json")
+
+
+def every(sim, period, fn=None, **state):
+    # fn() and/or state now and every `period` sim seconds after
+    def event():
+        sim.set(**state)
+        if fn is not None:
+            fn()
+        sim.clock.schedule(sim.clock.now + period, event)
+    sim.clock.schedule(sim.clock.now, event)
+
+def command(flag, period=7.0):
+    return lambda sim, ctrl: every(sim, period, lambda: ctrl.audio_judge(flag))
+
+def pulse(period, width, on, off):
+    # hold robot state `on` for `width` seconds out of every `period`
+    def setup(sim, ctrl):
+        every(sim, period, **on)
+        sim.clock.schedule(sim.clock.now + width, lambda: every(sim, period, **off))
+    return setup
+
+MODES = {
+    "idle": lambda sim, ctrl: None,
+    "touch_head": lambda sim, ctrl: sim.set(touch_head=1),
+    "touch_body": lambda sim, ctrl: sim.set(touch_body=500),
+    "dance": command("dance", 6.0),
+    "hello": command("hello"),
+    "left": command("left", 1.0),
+    "right": command("right", 1.0),
+    "move": command("move", 2.0),
+    "back": command("back", 2.0),
+    "round": command("round", 1.0),
+    "cliff_left": pulse(3.0, 0.2, {"cliff": (0.9, 0.1)}, {"cliff": (0.9, 0.9)}),
+    "cliff_right": pulse(3.0, 0.2, {"cliff": (0.1, 0.9)}, {"cliff": (0.9, 0.9)}),
+    "cliff_inverse": pulse(3.0, 0.2, {"cliff": (0.1, 0.1)}, {"cliff": (0.9, 0.9)}),
+    "sonar": pulse(5.0, 0.2, {"sonar": 0.1}, {"sonar": 1.0}),
+}
+
+
+def run_mode(name, ticks, warmup, repeat, script, params):
+    """
+    one mode on a fresh controller: best ticks/s over `repeat` timed runs,
+    then a tracemalloc pass for memory
+    """
+    with open(os.devnull, "w") as null, contextlib.redirect_stdout(null):
+        sim = Simulation(params)
+        ctl = sim.load(script)
+        ctrl = ctl.controller([])
+        MODES[name](sim, ctrl)
+        sim.run(ctrl, warmup)
+
+        best = 0.0
+        pubs = writes = 0
+        for _ in range(repeat):
+            pubs0, writes0 = sum(sim.publish_counts().values()), ctrl.frame.writes
+            wall = sim.run(ctrl, ticks)
+            best = max(best, ticks / wall)
+            pubs = sum(sim.publish_counts().values()) - pubs0
+            writes = ctrl.frame.writes - writes0
+
+        blocks0 = sys.getallocatedblocks()
+        tracemalloc.start()
+        start, _ = tracemalloc.get_traced_memory()
+        sim.run(ctrl, ticks)
+        end, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        blocks = sys.getallocatedblocks() - blocks0
+
+    return {
+        "ticks_per_s": round(best, 1),
+        "publishes_per_tick": round(pubs / ticks, 3),
+        "writes_per_tick": round(writes / ticks, 3),
+        "retained_bytes_per_tick": round((end - start) / ticks, 1),
+        "peak_transient_kib": round((peak - start) / 1024, 1),
+        "net_blocks_per_tick": round(blocks / ticks, 3),
+    }
+
+def compare(results, baseline, tolerance):
+    """
+    modes whose throughput fell more than `tolerance` below the baseline
+    """
+    failed = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        floor = base["ticks_per_s"] * (1.0 - tolerance)
+        if result["ticks_per_s"] < floor:
+            failed.append((name, result["ticks_per_s"], base["ticks_per_s"]))
+    return failed
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="benchmark test5.0.py's control loop per behaviour mode")
+    parser.add_argument("modes", nargs="*", help="modes to run (default all): " + ", ".join(MODES))
+    parser.add_argument("--ticks", type=int, default=3000)
+    parser.add_argument("--warmup", type=int, default=200)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--script", default=DEFAULT_SCRIPT)
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="allowed fractional drop in ticks/s before failing")
+    parser.add_argument("--save", action="store_true", help="write the results as the new baseline")
+    parser.add_argument("--json", help="also write the results here")
+    args = parser.parse_args(argv)
+
+    unknown = [m for m in args.modes if m not in MODES]
+    if unknown:
+        parser.error("unknown mode: " + ", ".join(unknown))
+
+    results = {}
+    print(f"{'mode':14s} {'ticks/s':>9s} {'pub/tick':>9s} {'wr/tick':>8s} "
+          f"{'B/tick':>8s} {'peak KiB':>9s} {'blk/tick':>9s}")
+    for name in args.modes or MODES:
+        r = results[name] = run_mode(name, args.ticks, args.warmup, args.repeat,
+                                     args.script, {"~timeline_cache": ""})
+        print(f"{name:14s} {r['ticks_per_s']:9.0f} {r['publishes_per_tick']:9.3f} "
+              f"{r['writes_per_tick']:8.3f} {r['retained_bytes_per_tick']:8.1f} "
+              f"{r['peak_transient_kib']:9.1f} {r['net_blocks_per_tick']:9.3f}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.save:
+        baseline = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+        baseline.update(results)
+        with open(args.baseline, "w") as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+        print("baseline written to", args.baseline)
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print("no baseline at", args.baseline, "- run with --save to record one")
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    failed = compare(results, baseline, args.tolerance)
+    for name, now, base in failed:
+        print(f"REGRESSION {name}: {now:.0f} ticks/s, baseline {base:.0f}")
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
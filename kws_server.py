@@ -0,0 +1,274 @@
+#!/usr/bin/env python3
+#
+# keyword spotting daemon: loads the vosk model once and serves recognizer
+# sessions to any number of controller scripts over a Unix socket
+#
+#   python3 kws_server.py --model /home/mima123/vosk-model
+#
+# then run the controller with ~kws_server set (true for the default
+# socket, or a socket path). restarting a controller reconnects to the
+# running daemon instead of loading the model again.
+#
+# protocol: frames of (kind u8, session u32, length u32) + payload. a
+# client connection carries any number of sessions, each with its own
+# recognizer:
+#   OPEN    json options {"rate": 16000, "grammar": [...], "partial": bool}
+#   AUDIO   raw int16 mono samples
+#   CLOSE
+# the server answers per session with
+#   RESULT  json {"text": ...} for each finished utterance
+#   PARTIAL json {"partial": ...} after every block that does not finish
+#           an utterance, if asked for
+#   ERROR   utf-8 message
+
+import os
+import sys
+import json
+import queue
+import socket
+import signal
+import struct
+import asyncio
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+FRAME = struct.Struct("<BII")
+OPEN, AUDIO, CLOSE, RESULT, PARTIAL, ERROR = range(6)
+
+DEFAULT_SOCKET = os.path.join(os.environ.get("XDG_RUNTIME_DIR", "/tmp"), "miro-kws.sock")
+DEFAULT_MODEL = "/home/mima123/vosk-model"
+
+
+def frame(kind, session, payload=b""):
+    return FRAME.pack(kind, session, len(payload)) + payload
+
+
+################################################################
+# server
+
+class Session:
+    def __init__(self, server, writer, sid, options):
+        from vosk import KaldiRecognizer
+        rate = options.get("rate", 16000)
+        grammar = options.get("grammar")
+        if grammar:
+            self.rec = KaldiRecognizer(server.model, rate, json.dumps(grammar))
+        else:
+            self.rec = KaldiRecognizer(server.model, rate)
+        self.server = server
+        self.writer = writer
+        self.sid = sid
+        self.partial = options.get("partial", False)
+        # audio waits here in order; a slow client drops its oldest blocks
+        self.audio = asyncio.Queue(maxsize=server.backlog)
+        self.dropped = 0
+        self.task = asyncio.create_task(self.run())
+
+    def feed(self, data):
+        if self.audio.full():
+            self.audio.get_nowait()
+            self.dropped += 1
+        self.audio.put_nowait(data)
+
+    def close(self):
+        self.feed(None)
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                data = await self.audio.get()
+                if data is None:
+                    break
+                # decoding runs on the pool, one block at a time per session
+                final = await loop.run_in_executor(self.server.pool, self.rec.AcceptWaveform, data)
+                if final:
+                    await self.send(RESULT, self.rec.Result())
+                elif self.partial:
+                    await self.send(PARTIAL, self.rec.PartialResult())
+        except ConnectionError:
+            # the client went away mid-send; handle() closes the connection
+            pass
+
+    async def send(self, kind, text):
+        self.writer.write(frame(kind, self.sid, text.encode()))
+        await self.writer.drain()
+
+class KwsServer:
+    def __init__(self, model_path, socket_path=DEFAULT_SOCKET, workers=2, backlog=32):
+        from vosk import Model
+        print("loading", model_path)
+        self.model = Model(model_path)
+        self.socket_path = socket_path
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="kws")
+        self.backlog = backlog
+        self.sessions = 0
+
+    async def handle(self, reader, writer):
+        sessions = {}
+        try:
+            while True:
+                kind, sid, n = FRAME.unpack(await reader.readexactly(FRAME.size))
+                payload = await reader.readexactly(n) if n else b""
+                if kind == AUDIO:
+                    session = sessions.get(sid)
+                    if session is not None:
+                        session.feed(payload)
+                elif kind == OPEN:
+                    try:
+                        sessions[sid] = Session(self, writer, sid, json.loads(payload or b"{}"))
+                        self.sessions += 1
+                    except Exception as e:
+                        writer.write(frame(ERROR, sid, str(e).encode()))
+                elif kind == CLOSE:
+                    session = sessions.pop(sid, None)
+                    if session is not None:
+                        session.close()
+        except (asyncio.IncompleteReadError, ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            for session in sessions.values():
+                session.close()
+            writer.close()
+
+    async def serve(self):
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        server = await asyncio.start_unix_server(self.handle, path=self.socket_path)
+        print("serving on", self.socket_path)
+        # stop on SIGTERM too, so main() removes the socket
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, server.close)
+        async with server:
+            try:
+                await server.serve_forever()
+            except asyncio.CancelledError:
+                pass
+
+
+################################################################
+# client
+
+class KwsClient:
+    """
+    one connection to the daemon, shared by all sessions of a process
+    """
+
+    clients = {}
+
+    @classmethod
+    def connect(cls, path=DEFAULT_SOCKET):
+        client = cls.clients.get(path)
+        if client is None or client.closed:
+            client = cls.clients[path] = cls(path)
+        return client
+
+    def __init__(self, path):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path)
+        self.send_lock = threading.Lock()
+        self.sessions = {}
+        self.next_sid = 1
+        self.closed = False
+        self.reader = threading.Thread(target=self.read_loop, name="kws-client", daemon=True)
+        self.reader.start()
+
+    def send(self, kind, sid, payload=b""):
+        data = frame(kind, sid, payload)
+        with self.send_lock:
+            if self.closed:
+                return False
+            try:
+                self.sock.sendall(data)
+            except OSError:
+                self.closed = True
+                return False
+        return True
+
+    def open(self, options=None, on_partial=None):
+        with self.send_lock:
+            sid = self.next_sid
+            self.next_sid += 1
+        session = RemoteRecognizer(self, sid, on_partial)
+        self.sessions[sid] = session
+        self.send(OPEN, sid, json.dumps(options or {}).encode())
+        return session
+
+    def recv_exactly(self, n):
+        buf = bytearray()
+        while len(buf) < n:
+            chunk = self.sock.recv(n - len(buf))
+            if not chunk:
+                raise ConnectionError("kws server closed the connection")
+            buf += chunk
+        return bytes(buf)
+
+    def read_loop(self):
+        try:
+            while True:
+                kind, sid, n = FRAME.unpack(self.recv_exactly(FRAME.size))
+                payload = self.recv_exactly(n) if n else b""
+                session = self.sessions.get(sid)
+                if session is not None:
+                    session.receive(kind, payload)
+        except (OSError, ConnectionError):
+            pass
+        finally:
+            self.closed = True
+            for session in list(self.sessions.values()):
+                session.results.put(None)
+
+class KwsError(Exception):
+    """
+    the daemon could not open a session
+    """
+
+class RemoteRecognizer:
+    """
+    one recognizer session on the daemon
+
+    feed() streams audio without waiting; finished utterances arrive on
+    `results` as lower-case text (a KwsError if the daemon refused the
+    session, None once the connection is gone), partial texts go to
+    on_partial(text) if given.
+    """
+
+    def __init__(self, client, sid, on_partial=None):
+        self.client = client
+        self.sid = sid
+        self.on_partial = on_partial
+        self.results = queue.Queue()
+
+    def feed(self, data):
+        return self.client.send(AUDIO, self.sid, bytes(data))
+
+    def receive(self, kind, payload):
+        if kind == RESULT:
+            self.results.put(json.loads(payload).get("text", "").lower())
+        elif kind == PARTIAL and self.on_partial is not None:
+            self.on_partial(json.loads(payload).get("partial", "").lower())
+        elif kind == ERROR:
+            self.results.put(KwsError(payload.decode(errors="replace")))
+
+    def close(self):
+        self.client.send(CLOSE, self.sid)
+        self.client.sessions.pop(self.sid, None)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="shared vosk keyword spotting daemon")
+    parser.add_argument("--model", default=DEFAULT_MODEL)
+    parser.add_argument("--socket", default=DEFAULT_SOCKET)
+    parser.add_argument("--workers", type=int, default=2, help="decoder threads shared by all sessions")
+    args = parser.parse_args(argv)
+    server = KwsServer(args.model, args.socket, args.workers)
+    try:
+        asyncio.run(server.serve())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if os.path.exists(args.socket):
+            os.unlink(args.socket)
+
+if __name__ == "__main__":
+    sys.exit(main())
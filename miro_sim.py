@@ -0,0 +1,631 @@
+#!/usr/bin/env python3
+#
+# headless simulation backend for test5.0.py
+#
+# stands in for rospy, miro2, the ROS message packages, vosk and
+# sounddevice, and runs the controller on a simulated clock, so thousands
+# of ticks run per second on a plain Linux box with no ROS master.
+#
+#   python3 miro_sim.py --ticks 5000
+#
+#   sim = Simulation()
+#   ctl = sim.load()
+#   c = ctl.controller([])
+#   sim.after(2.0, sonar=0.1)
+#   sim.say("dance", delay=5.0)
+#   sim.run(c, 1000)
+#
+# a sensor log recorded on the robot (~record) replays in place of the
+# simulated robot, as fast as possible or paced at 1x:
+#
+#   python3 miro_sim.py --replay session.log [--realtime]
+
+import os
+import sys
+import json
+import time
+import heapq
+import types
+import argparse
+import importlib.util
+from collections import deque, Counter
+
+import numpy as np
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_SCRIPT = os.path.join(HERE, "test5.0.py")
+
+
+################################################################
+# messages
+
+class Stamp:
+    def __init__(self, t=0.0):
+        self.secs = int(t)
+        self.nsecs = int(round((t - self.secs) * 1e9))
+
+    def to_sec(self):
+        return self.secs + self.nsecs * 1e-9
+
+class Header:
+    def __init__(self):
+        self.seq = 0
+        self.stamp = Stamp()
+        self.frame_id = ""
+
+class Vector3:
+    def __init__(self, x=0.0, y=0.0, z=0.0):
+        self.x = x
+        self.y = y
+        self.z = z
+
+class Twist:
+    def __init__(self):
+        self.linear = Vector3()
+        self.angular = Vector3()
+
+class TwistStamped:
+    def __init__(self):
+        self.header = Header()
+        self.twist = Twist()
+
+class JointState:
+    def __init__(self):
+        self.header = Header()
+        self.name = []
+        self.position = []
+        self.velocity = []
+        self.effort = []
+
+class Scalar:
+    def __init__(self, data=0):
+        self.data = data
+
+class Array:
+    def __init__(self, data=None):
+        self.data = [] if data is None else data
+
+class String:
+    def __init__(self, data=""):
+        self.data = data
+
+class Range:
+    def __init__(self, range=1.0):
+        self.header = Header()
+        self.range = range
+
+class Imu:
+    def __init__(self):
+        self.header = Header()
+
+class Odometry:
+    def __init__(self):
+        self.header = Header()
+        self.twist = types.SimpleNamespace(twist=Twist())
+
+class Battery:
+    def __init__(self, voltage=4.8):
+        self.voltage = voltage
+
+class sensors_package:
+    def __init__(self):
+        self.header = Header()
+        self.touch_head = Scalar(0)
+        self.touch_body = Scalar(0)
+        self.sonar = Range(1.0)
+        self.battery = Battery()
+        self.odom = Odometry()
+
+class push:
+    def __init__(self):
+        self.link = 0
+        self.flags = 0
+        self.pushpos = Vector3()
+        self.pushvec = Vector3()
+
+class animal_state:
+    def __init__(self):
+        self.emotion = types.SimpleNamespace(valence=0.0, arousal=0.0)
+        self.sleep = types.SimpleNamespace(wakefulness=1.0, pressure=0.0)
+        self.sound_level = 0.0
+        self.flags = 0
+
+
+################################################################
+# clock
+
+class SimClock:
+    """
+    simulated time; sleep() advances it and fires the events due on the way
+    """
+
+    def __init__(self, start=1000.0, realtime=False):
+        self.now = start
+        self.events = []
+        self.seq = 0
+        # pace sim time to the wall clock (1x replay)
+        self.realtime = realtime
+
+    def time(self):
+        return self.now
+
+    def schedule(self, t, fn):
+        self.seq += 1
+        heapq.heappush(self.events, (t, self.seq, fn))
+
+    def sleep(self, seconds):
+        if self.realtime and seconds > 0.0:
+            time.sleep(seconds)
+        end = self.now + max(seconds, 0.0)
+        while self.events and self.events[0][0] <= end:
+            t, _, fn = heapq.heappop(self.events)
+            self.now = max(self.now, t)
+            fn()
+        self.now = end
+
+    def module(self):
+        # a `time` module whose wall and monotonic clocks are simulated;
+        # perf_counter stays real so CPU cost can still be measured
+        fake = types.ModuleType("time")
+        fake.__dict__.update({k: getattr(time, k) for k in dir(time) if not k.startswith("__")})
+        fake.time = fake.monotonic = self.time
+        fake.time_ns = fake.monotonic_ns = lambda: int(self.now * 1e9)
+        fake.sleep = self.sleep
+        return fake
+
+
+################################################################
+# rospy
+
+class Duration:
+    def __init__(self, secs=0.0):
+        self.secs = secs
+
+    def to_sec(self):
+        return self.secs
+
+class SimPublisher:
+    def __init__(self, sim, topic, msg_type, queue_size=None, **kwargs):
+        self.sim = sim
+        self.name = topic
+        self.msg_type = msg_type
+        self.count = 0
+        self.last = None
+        sim.publishers.append(self)
+
+    def publish(self, msg):
+        self.count += 1
+        self.last = msg
+        self.sim.deliver(self.name, msg)
+
+    def get_num_connections(self):
+        return 1
+
+    def unregister(self):
+        pass
+
+class SimSubscriber:
+    def __init__(self, sim, topic, msg_type, callback, **kwargs):
+        self.name = topic
+        self.callback = callback
+        sim.subscribers.setdefault(topic, []).append(callback)
+
+    def unregister(self):
+        pass
+
+class SimTimer:
+    def __init__(self, sim, period, callback, oneshot=False):
+        self.sim = sim
+        self.period = period.to_sec() if hasattr(period, "to_sec") else period
+        self.callback = callback
+        self.oneshot = oneshot
+        self.running = True
+        sim.clock.schedule(sim.clock.now + self.period, self.fire)
+
+    def fire(self):
+        if not self.running:
+            return
+        self.callback(types.SimpleNamespace(current_real=self.sim.clock.now))
+        if not self.oneshot:
+            self.sim.clock.schedule(self.sim.clock.now + self.period, self.fire)
+
+    def shutdown(self):
+        self.running = False
+
+def make_rospy(sim):
+    rospy = types.ModuleType("rospy")
+    rospy.Duration = Duration
+    rospy.init_node = lambda name, **kwargs: None
+    rospy.Publisher = lambda *a, **k: SimPublisher(sim, *a, **k)
+    rospy.Subscriber = lambda *a, **k: SimSubscriber(sim, *a, **k)
+    rospy.Timer = lambda period, callback, oneshot=False: SimTimer(sim, period, callback, oneshot)
+    rospy.get_param = lambda name, default=None: sim.params.get(name, default)
+    rospy.get_time = sim.clock.time
+    rospy.sleep = lambda d: sim.clock.sleep(d.to_sec() if hasattr(d, "to_sec") else d)
+    rospy.spin = lambda: None
+    rospy.signal_shutdown = lambda reason="": sim.shutdown()
+    rospy.ROSInterruptException = type("ROSInterruptException", (Exception,), {})
+    for level in ("logdebug", "loginfo", "logwarn", "logerr", "logfatal"):
+        rospy.__dict__[level] = (lambda level: lambda msg, *args, **kwargs:
+                                 sim.log_message(level, msg, args))(level)
+    rospy.core = types.SimpleNamespace(is_shutdown=sim.is_shutdown)
+    return rospy
+
+
+################################################################
+# vosk / sounddevice
+
+# samples of audio one said utterance lasts
+UTTERANCE_SAMPLES = 8000
+
+def voice(samples, f0=150.0, rate=16000):
+    """
+    int16 bytes of a steady vowel-like sound, for voice activity gates
+    """
+    t = np.arange(samples) / rate
+    wave = sum(np.sin(2 * np.pi * f0 * k * t) / k for k in range(1, 9))
+    return (3000 * wave).astype(np.int16).tobytes()
+
+class SimRecognizer:
+    """
+    finishes each said utterance once UTTERANCE_SAMPLES of audio have been
+    fed after it, partial results reveal its heard words as audio arrives
+    """
+
+    def __init__(self, sim, model=None, rate=16000, grammar=None):
+        self.sim = sim
+        self.grammar = grammar
+        self.text = ""
+        self.current = None  # (text, heard words)
+        self.fed = 0
+
+    def AcceptWaveform(self, data):
+        if self.current is None:
+            if not self.sim.utterances:
+                return False
+            self.current = self.sim.utterances.popleft()
+            self.fed = 0
+        self.fed += len(data) // 2
+        if self.fed >= UTTERANCE_SAMPLES:
+            self.text = self.current[0]
+            self.current = None
+            return True
+        return False
+
+    def Result(self):
+        text, self.text = self.text, ""
+        return json.dumps({"text": text})
+
+    def FinalResult(self):
+        return self.Result()
+
+    def PartialResult(self):
+        if self.current is None:
+            return json.dumps({"partial": ""})
+        words = self.current[1]
+        n = -(-len(words) * self.fed // UTTERANCE_SAMPLES)
+        return json.dumps({"partial": " ".join(words[:n])})
+
+    def SetWords(self, words):
+        pass
+
+class SimInputStream:
+    def __init__(self, sim, callback=None, blocksize=8000, **kwargs):
+        self.sim = sim
+        self.callback = callback
+        self.blocksize = blocksize
+        sim.streams.append(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def close(self):
+        pass
+
+
+################################################################
+# simulation
+
+class Simulation:
+    """
+    one simulated robot and the fake modules test5.0.py imports
+
+    the robot publishes its sensors package and cliff array every period,
+    half a tick out of phase with the controller, and echoes the last
+    cmd_vel turn rate back as odometry. scripted changes to its sensors and
+    spoken keywords are scheduled on the sim clock.
+    """
+
+    def __init__(self, params=None, robot_name="miro", period=0.02, sensor_rate=50.0,
+                 verbose=False):
+        self.clock = SimClock()
+        self.robot_name = robot_name
+        self.period = period
+        self.verbose = verbose
+        # decode on the audio callback, so say() is handled deterministically
+        self.params = {"~timeline_cache": "", "~kws_decode_thread": False}
+        self.params.update(params or {})
+
+        self.publishers = []
+        self.subscribers = {}
+        self.streams = []
+        self.utterances = deque()
+        self.log = deque(maxlen=1000)
+        self.stopped = False
+        self.stop_time = None
+        self.module = None
+
+        # robot state, published until a replay takes over
+        self.robot_publishing = True
+        self.touch_head = 0
+        self.touch_body = 0
+        self.sonar = 1.0
+        self.cliff = (0.9, 0.9)
+        self.yaw_rate = 0.0
+        self.speed = 0.0
+
+        self.sensor_period = 1.0 / sensor_rate
+        self.clock.schedule(self.clock.now + self.period / 2, self.publish_sensors)
+
+    # fake modules
+    def modules(self):
+        msg = types.ModuleType("std_msgs.msg")
+        for name in ("UInt8", "UInt16", "UInt32", "Int32", "Float32", "Bool"):
+            setattr(msg, name, Scalar)
+        for name in ("Float32MultiArray", "UInt16MultiArray", "UInt32MultiArray", "Int32MultiArray"):
+            setattr(msg, name, Array)
+        msg.String = String
+        std_msgs = types.ModuleType("std_msgs")
+        std_msgs.msg = msg
+
+        gmsg = types.ModuleType("geometry_msgs.msg")
+        gmsg.Vector3, gmsg.Twist, gmsg.TwistStamped = Vector3, Twist, TwistStamped
+        geometry_msgs = types.ModuleType("geometry_msgs")
+        geometry_msgs.msg = gmsg
+
+        smsg = types.ModuleType("sensor_msgs.msg")
+        smsg.JointState, smsg.Imu, smsg.Range = JointState, Imu, Range
+        sensor_msgs = types.ModuleType("sensor_msgs")
+        sensor_msgs.msg = smsg
+
+        miro = types.ModuleType("miro2")
+        miro.msg = types.SimpleNamespace(sensors_package=sensors_package, push=push,
+                                         animal_state=animal_state)
+        miro.constants = types.SimpleNamespace(
+            ANIMAL_EXPRESS_THROUGH_VOICE=1, LINK_HEAD=3, PUSH_FLAG_VELOCITY=2,
+            LOC_NOSE_TIP_X=0.12, LOC_NOSE_TIP_Y=0.0, LOC_NOSE_TIP_Z=0.1)
+
+        vosk = types.ModuleType("vosk")
+        vosk.Model = lambda path=None, **kwargs: types.SimpleNamespace(path=path)
+        vosk.KaldiRecognizer = lambda *a, **k: SimRecognizer(self, *a, **k)
+        vosk.SetLogLevel = lambda level: None
+
+        sd = types.ModuleType("sounddevice")
+        sd.RawInputStream = lambda **kwargs: SimInputStream(self, **kwargs)
+
+        return {
+            "rospy": make_rospy(self),
+            "miro2": miro,
+            "std_msgs": std_msgs, "std_msgs.msg": msg,
+            "geometry_msgs": geometry_msgs, "geometry_msgs.msg": gmsg,
+            "sensor_msgs": sensor_msgs, "sensor_msgs.msg": smsg,
+            "vosk": vosk,
+            "sounddevice": sd,
+        }
+
+    def install(self):
+        sys.modules.update(self.modules())
+        os.environ.setdefault("MIRO_ROBOT_NAME", self.robot_name)
+
+    def load(self, path=DEFAULT_SCRIPT, name="miro_controller"):
+        """
+        import the controller script against the fake modules and the sim clock
+        """
+        self.install()
+        spec = importlib.util.spec_from_file_location(name, path)
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[name] = module
+        spec.loader.exec_module(module)
+        module.time = self.clock.module()
+        # log rate limits and times follow the sim clock too
+        module.LOG.clock = self.clock.time
+        module.LOG.t0 = self.clock.now
+        module.STARTUP_T0 = self.clock.now
+        self.module = module
+        return module
+
+    # rospy backing
+    def deliver(self, topic, msg):
+        if topic == f"/{self.robot_name}/control/cmd_vel":
+            self.speed = msg.twist.linear.x
+            self.yaw_rate = msg.twist.angular.z
+        for callback in self.subscribers.get(topic, ()):
+            callback(msg)
+
+    def log_message(self, level, msg, args):
+        text = msg % args if args else str(msg)
+        self.log.append((self.clock.now, level, text))
+        if self.verbose:
+            print(f"[{level}] {text}")
+
+    def is_shutdown(self):
+        return self.stopped or (self.stop_time is not None and self.clock.now >= self.stop_time)
+
+    def shutdown(self):
+        self.stopped = True
+
+    # robot
+    def publish_sensors(self):
+        if not self.robot_publishing:
+            return
+        base = "/" + self.robot_name
+        pkg = sensors_package()
+        pkg.header.stamp = Stamp(self.clock.now)
+        pkg.touch_head.data = self.touch_head
+        pkg.touch_body.data = self.touch_body
+        pkg.sonar.range = self.sonar
+        pkg.odom.twist.twist.angular.z = self.yaw_rate
+        pkg.odom.twist.twist.linear.x = self.speed
+        self.deliver(base + "/sensors/package", pkg)
+        self.deliver(base + "/sensors/cliff", Array(list(self.cliff)))
+        self.clock.schedule(self.clock.now + self.sensor_period, self.publish_sensors)
+
+    def set(self, **state):
+        for key, value in state.items():
+            if not hasattr(self, key):
+                raise AttributeError(f"no robot state {key}")
+            setattr(self, key, value)
+
+    # script
+    def after(self, delay, fn=None, **state):
+        """
+        in `delay` sim seconds call fn() and/or set robot state
+        (touch_head, touch_body, sonar, cliff)
+        """
+        def event():
+            self.set(**state)
+            if fn is not None:
+                fn()
+        self.clock.schedule(self.clock.now + delay, event)
+
+    def say(self, text, delay=0.0, heard=None):
+        """
+        speak `text` into the microphone: UTTERANCE_SAMPLES of audio in the
+        streams' block size, after which the recognizer returns it. partial
+        results show `heard` (default `text`), to fake a misrecognition
+        """
+        def speak():
+            self.utterances.append((text, (text if heard is None else heard).split()))
+            for stream in list(self.streams):
+                if stream.callback is None:
+                    continue
+                block = voice(stream.blocksize)
+                for i in range(-(-UTTERANCE_SAMPLES // stream.blocksize)):
+                    self.clock.schedule(self.clock.now + (i + 1) * stream.blocksize / 16000.0,
+                                        lambda s=stream, b=block: s.callback(b, len(b) // 2, None, None))
+        self.after(delay, speak)
+
+    def replay(self, path, realtime=False):
+        """
+        feed a SensorRecorder log to the controller in place of the simulated
+        robot, from now on; return its length in seconds. packages are
+        restamped with sim time. audio blocks go to the microphone callback.
+        """
+        log = self.module.SensorLog(path)
+        self.robot_publishing = False
+        self.clock.realtime = realtime
+        base = "/" + self.robot_name
+        start = self.clock.now
+
+        def package(row, samples):
+            pkg = sensors_package()
+            pkg.header.stamp = Stamp(self.clock.now)
+            pkg.touch_head.data = int(row["touch_head"])
+            pkg.touch_body.data = int(row["touch_body"])
+            pkg.sonar.range = float(row["sonar"])
+            pkg.odom.twist.twist.angular.z = float(row["yaw_rate"])
+            pkg.odom.twist.twist.linear.x = float(row["speed"])
+            self.deliver(base + "/sensors/package", pkg)
+
+        def cliff(row, samples):
+            self.deliver(base + "/sensors/cliff", Array([float(row["left"]), float(row["right"])]))
+
+        def audio(row, samples):
+            for stream in list(self.streams):
+                if stream.callback is not None:
+                    stream.callback(samples, len(samples) // 2, None, None)
+
+        # one pending event per stream, each schedules the next row
+        def feed(rows, handler):
+            row = next(rows, None)
+            if row is None:
+                return
+            def event():
+                handler(*row)
+                feed(rows, handler)
+            self.clock.schedule(start + float(row[0]["t"]), event)
+
+        feed(log.rows(self.module.LOG_PACKAGE), package)
+        feed(log.rows(self.module.LOG_CLIFF), cliff)
+        feed(log.rows(self.module.LOG_AUDIO), audio)
+        return log.duration()
+
+    def run(self, ctrl, ticks):
+        """
+        run ctrl.loop() for `ticks` control ticks of sim time, return the
+        wall time it took
+        """
+        # the listener loads in the background; wait, so say() is deterministic
+        listener = getattr(ctrl, "Audio", None)
+        if listener is not None and listener.results is None:
+            listener.loaded.wait(10.0)
+        self.stop_time = self.clock.now + (ticks - 0.5) * ctrl.scheduler.period
+        t0 = time.perf_counter()
+        try:
+            ctrl.loop()
+        finally:
+            self.stop_time = None
+        return time.perf_counter() - t0
+
+    def publish_counts(self):
+        counts = Counter()
+        for pub in self.publishers:
+            counts[pub.name] += pub.count
+        return dict(counts)
+
+
+def demo_script(sim):
+    # touch, voice command, sonar obstacle, cliff; relative to now
+    sim.after(1.0, touch_head=1)
+    sim.after(2.0, touch_head=0)
+    sim.say("dance", delay=3.0)
+    sim.after(10.0, sonar=0.1)
+    sim.after(10.5, sonar=1.0)
+    sim.after(16.0, cliff=(0.9, 0.1))
+    sim.after(16.2, cliff=(0.9, 0.9))
+    sim.say("hello", delay=20.0)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="run test5.0.py headless on a simulated clock")
+    parser.add_argument("--ticks", type=int, default=5000)
+    parser.add_argument("--script", default=DEFAULT_SCRIPT)
+    parser.add_argument("--param", action="append", default=[], metavar="NAME=JSON",
+                        help="private ROS param, e.g. --param overrun_policy='\"catchup\"'")
+    parser.add_argument("--verbose", action="store_true")
+    parser.add_argument("--replay", metavar="LOG", help="replay a ~record sensor log instead of the demo script")
+    parser.add_argument("--realtime", action="store_true", help="pace the replay at 1x")
+    args = parser.parse_args(argv)
+
+    params = {}
+    for item in args.param:
+        name, _, value = item.partition("=")
+        params["~" + name.lstrip("~")] = json.loads(value)
+
+    sim = Simulation(params, verbose=args.verbose)
+    ctl = sim.load(args.script)
+    ctrl = ctl.controller([])
+    if args.replay:
+        duration = sim.replay(args.replay, args.realtime)
+        ticks = int(duration / ctrl.scheduler.period) + 1
+    else:
+        demo_script(sim)
+        ticks = args.ticks
+    wall = sim.run(ctrl, ticks)
+
+    print(f"{ctrl.tick} ticks in {wall:.3f} s wall, {ctrl.tick / wall:.0f} ticks/s")
+    print("scheduler", ctrl.scheduler.stats())
+    print("actions", {k: getattr(ctrl.actions, k) for k in ("started", "completed", "cancelled", "refused")})
+    for topic, count in sorted(sim.publish_counts().items()):
+        print(f"  {topic:40s} {count}")
+
+if __name__ == "__main__":
+    main()
@@ -57,16 +57,185 @@ from geometry_msgs import *
 from geometry_msgs.msg import TwistStamped
 from sensor_msgs.msg import JointState, Imu
 from std_msgs.msg import UInt8, UInt16, UInt32, Float32MultiArray, UInt16MultiArray, UInt32MultiArray
+from std_msgs.msg import String
 from sensor_msgs.msg import Range
 
 import rospy
 from sensor_msgs.msg import JointState
-from vosk import Model, KaldiRecognizer
-import sounddevice as sd
 import json
+import hashlib
+import copy
+from fractions import Fraction
 import threading
+from collections import deque
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import atexit
+import struct
+import zlib
+import mmap
+import queue
+import multiprocessing
+from multiprocessing import shared_memory
+import itertools
+
+# startup stages are timed from here (see controller.report_startup)
+STARTUP_T0 = time.monotonic()
 ################################################################
 
+class RingLog:
+    """
+    in-memory log for hot paths
+
+    log() only checks the site's rate limit and fills a slot of a
+    preallocated ring; formatting and I/O happen when a background thread
+    flushes the ring to its sinks. each slot is committed by writing its
+    sequence number last, so the flusher never reads a half written entry.
+    messages over a site's rate, or overwritten before a flush, are counted
+    and reported with the next flush.
+    """
+
+    def __init__(self, size=4096, clock=None):
+        self.size = size
+        self.clock = clock or time.monotonic
+        self.t0 = self.clock()
+        self.counter = itertools.count()
+        self.head = -1
+        self.seqs = [-1] * size
+        self.times = [0.0] * size
+        self.sites = [0] * size
+        self.args = [None] * size
+
+        self.names = []
+        self.formats = []
+        self.levels = []
+        self.intervals = []
+        self.last = []
+        self.suppressed = []
+        self.reported = []
+
+        self.flushed = 0
+        self.lost = 0
+        self.sinks = []
+        self.thread = None
+        self.stop_event = threading.Event()
+        self.flush_lock = threading.Lock()
+
+    def site(self, name, fmt, rate=None, level="info"):
+        """
+        register a log site, at most `rate` messages per second; returns its id
+        """
+        self.names.append(name)
+        self.formats.append(fmt)
+        self.levels.append(level)
+        self.intervals.append(1.0 / rate if rate else 0.0)
+        self.last.append(-1e9)
+        self.suppressed.append(0)
+        self.reported.append(0)
+        return len(self.names) - 1
+
+    def log(self, site, *args):
+        now = self.clock()
+        if now - self.last[site] < self.intervals[site]:
+            self.suppressed[site] += 1
+            return
+        self.last[site] = now
+        n = next(self.counter)
+        i = n % self.size
+        self.times[i] = now
+        self.sites[i] = site
+        self.args[i] = args
+        self.seqs[i] = n
+        self.head = n
+
+    def drain(self):
+        """
+        format and remove the committed entries, oldest first
+        """
+        lines = []
+        n = self.flushed
+        while True:
+            i = n % self.size
+            seq = self.seqs[i]
+            if seq < n:
+                break
+            if seq > n:
+                # the writer lapped us: only the last `size` entries are
+                # still in the ring, the ones before them are gone
+                oldest = max(n, max(self.head, seq) - self.size + 1)
+                self.lost += oldest - n
+                n = oldest
+                continue
+            t, site, args = self.times[i], self.sites[i], self.args[i]
+            if self.seqs[i] != seq:
+                continue
+            try:
+                text = self.formats[site] % args
+            except (TypeError, ValueError):
+                text = f"{self.formats[site]} {args}"
+            lines.append(f"{t - self.t0:10.3f} [{self.levels[site]}] {self.names[site]}: {text}")
+            n += 1
+        self.flushed = n
+        now = self.clock() - self.t0
+        if self.lost:
+            lines.append(f"{now:10.3f} [warn] log: {self.lost} messages lost, the ring overran")
+            self.lost = 0
+        # only log() writes suppressed, from any thread; count what is new
+        # since the last report instead of resetting it
+        for site, count in enumerate(self.suppressed):
+            count -= self.reported[site]
+            if count:
+                self.reported[site] += count
+                lines.append(f"{now:10.3f} [info] {self.names[site]}: "
+                             f"{count} messages over the rate limit")
+        return lines
+
+    def flush(self):
+        with self.flush_lock:
+            lines = self.drain()
+            if lines:
+                for sink in self.sinks:
+                    sink(lines)
+
+    def start(self, sinks, period=0.5):
+        if self.thread is not None:
+            return
+        self.sinks = list(sinks)
+        self.thread = threading.Thread(target=self.run, args=(period,), daemon=True)
+        self.thread.start()
+        atexit.register(self.stop)
+
+    def run(self, period):
+        while not self.stop_event.wait(period):
+            self.flush()
+
+    def stop(self):
+        self.stop_event.set()
+        self.flush()
+
+def print_sink(lines):
+    print("\n".join(lines))
+
+def file_sink(path):
+    f = open(path, "a")
+    def write(lines):
+        f.write("\n".join(lines) + "\n")
+        f.flush()
+    return write
+
+# process wide; sinks are set by the first controller (see controller.start_log)
+LOG = RingLog()
+SITE_CLIFF = LOG.site("cliff", "cliff right %s left %s", rate=2.0)
+SITE_AVOID = LOG.site("avoidance", "%s", rate=2.0)
+SITE_SONAR = LOG.site("sonar", "sonar")
+SITE_EMOTION = LOG.site("emotion", " miro emotion: %s")
+SITE_TEXT = LOG.site("kws", "🧪 识别文本: %s")
+SITE_KEYWORD = LOG.site("kws", "🗣️ 识别到关键词：%s")
+SITE_EARLY = LOG.site("kws", "🗣️ 识别到关键词：%s (partial)")
+SITE_CONFIRM = LOG.site("kws", "keyword %s confirmed")
+SITE_WITHDRAW = LOG.site("kws", "keyword %s withdrawn, final text: %s")
+SITE_OVERFLOW = LOG.site("audio", "audio input overflow, %d so far", rate=1.0)
+
 
 class EmotionController:
     def __init__(self, pub_animal_state):
@@ -83,6 +252,9 @@ class EmotionController:
             "neutral":   (0.0, 0.5, 0.1, 1.0),
         }
 
+        # latest requested state, published by update() on the emotion rate
+        self.pending = None
+
     def express_emotion(self, valence=1.0, arousal=1.0, sound_level=0.1, wakefulness=1.0):
         """
         control emotion
@@ -93,6 +265,13 @@ class EmotionController:
         msg.sound_level = sound_level
         msg.sleep.wakefulness = wakefulness
         msg.flags = miro.constants.ANIMAL_EXPRESS_THROUGH_VOICE
+        self.pending = msg
+
+    def update(self):
+        msg = self.pending
+        if msg is None:
+            return
+        self.pending = None
         i = 0
         while (i < 5):
             i = i +1
@@ -106,9 +285,247 @@ class EmotionController:
             return
 
         valence, arousal, sound_level, wakefulness = self.emotion_map[keyword]
-        rospy.loginfo(f" miro emotion: {keyword}")
+        LOG.log(SITE_EMOTION, keyword)
         self.express_emotion(valence, arousal, sound_level, wakefulness)
 
+# vosk models by path, loaded once per process
+VOSK_MODELS = {}
+
+def load_vosk_model(path):
+    # vosk is imported on first use, it is slow to import
+    from vosk import Model
+    model = VOSK_MODELS.get(path)
+    if model is None:
+        model = VOSK_MODELS[path] = Model(path)
+    return model
+
+class AudioRing:
+    """
+    single producer / single consumer byte ring in shared memory
+
+    the header holds the total bytes written and read as two uint64
+    counters, each only advanced by its own side. a block that does not fit
+    is dropped rather than overwriting unread audio.
+    """
+
+    HEADER = 16
+
+    def __init__(self, capacity=128000, name=None):
+        self.capacity = capacity
+        self.shm = shared_memory.SharedMemory(name=name, create=name is None,
+                                              size=self.HEADER + capacity)
+        self.name = self.shm.name
+        self.index = np.ndarray(2, np.uint64, self.shm.buf, 0)  # written, read
+        self.data = np.ndarray(capacity, np.uint8, self.shm.buf, self.HEADER)
+        if name is None:
+            self.index[:] = 0
+        self.dropped = 0
+
+    def write(self, block):
+        block = np.frombuffer(block, np.uint8)
+        n = len(block)
+        w, r = int(self.index[0]), int(self.index[1])
+        if w - r + n > self.capacity:
+            self.dropped += 1
+            return False
+        i = w % self.capacity
+        first = min(n, self.capacity - i)
+        self.data[i:i + first] = block[:first]
+        self.data[:n - first] = block[first:]
+        self.index[0] = w + n
+        return True
+
+    def read(self):
+        w, r = int(self.index[0]), int(self.index[1])
+        n = w - r
+        if n == 0:
+            return b""
+        i = r % self.capacity
+        first = min(n, self.capacity - i)
+        data = self.data[i:i + first].tobytes() + self.data[:n - first].tobytes()
+        self.index[1] = r + n
+        return data
+
+    def close(self, unlink=False):
+        # drop the numpy views first, shm refuses to close while they exist
+        self.index = self.data = None
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+
+class VoiceGate:
+    """
+    voice activity gate in front of the recognizer
+
+    each block is cut into 20 ms frames and judged on three features at
+    once with numpy: energy over an adaptive noise floor, zero crossing rate
+    (hiss crosses zero far more often than voice) and spectral flatness
+    (noise has a flat spectrum, voice has harmonics). a block with at least
+    min_frames voiced frames opens the gate. the blocks of the last pre_roll
+    seconds are passed on when it opens, so word onsets are kept, and it
+    stays open for `hangover` seconds of silence after, long enough for the
+    recognizer to see the end of the utterance.
+    """
+
+    def __init__(self, rate=16000, frame=0.02, margin=10.0, min_db=30.0, max_zcr=0.4,
+                 max_flatness=0.4, min_frames=2, pre_roll=0.3, hangover=0.8):
+        self.frame = int(rate * frame)
+        self.window = np.hanning(self.frame).astype(np.float32)
+        self.margin = margin
+        self.min_db = min_db
+        self.max_zcr = max_zcr
+        self.max_flatness = max_flatness
+        self.min_frames = min_frames
+        self.pre_roll = int(rate * pre_roll)
+        self.hangover = int(rate * hangover)
+
+        # noise floor, dB. it starts low and follows the median frame: down
+        # within a few frames, up over seconds, so steady noise (wheels, fans)
+        # is absorbed while words are too short to move it much
+        self.floor = min_db - margin
+        self.fall = 0.2  # per frame
+        self.rise = 0.02
+        self.held = deque()
+        self.held_samples = 0
+        self.hang = 0
+
+        # counters
+        self.passed = 0
+        self.skipped = 0
+        self.openings = 0
+
+    def voiced(self, samples):
+        """
+        number of voiced frames in a block of int16 samples
+        """
+        n = len(samples) // self.frame
+        if n == 0:
+            return 0
+        frames = samples[:n * self.frame].reshape(n, self.frame).astype(np.float32)
+        energy = 10.0 * np.log10(np.mean(frames * frames, axis=1) + 1e-9)
+        zcr = np.mean(np.signbit(frames[:, 1:]) != np.signbit(frames[:, :-1]), axis=1)
+        power = np.abs(np.fft.rfft(frames * self.window, axis=1)) ** 2 + 1e-12
+        flatness = np.exp(np.mean(np.log(power), axis=1)) / np.mean(power, axis=1)
+
+        loud = energy > max(self.floor + self.margin, self.min_db)
+        voiced = loud & (zcr < self.max_zcr) & (flatness < self.max_flatness)
+
+        level = float(np.median(energy))
+        rate = self.fall if level < self.floor else self.rise
+        self.floor += (1.0 - (1.0 - rate) ** n) * (level - self.floor)
+        return int(np.count_nonzero(voiced))
+
+    def process(self, block):
+        """
+        the blocks to hand to the recognizer for this one, oldest first
+        """
+        block = bytes(block)
+        samples = np.frombuffer(block, np.int16)
+        if self.voiced(samples) >= self.min_frames:
+            if self.hang <= 0:
+                self.openings += 1
+            self.hang = self.hangover
+        elif self.hang > 0:
+            self.hang -= len(samples)
+        else:
+            # closed: keep the block as pre-roll for the next opening
+            self.held.append(block)
+            self.held_samples += len(samples)
+            while self.held and self.held_samples - len(self.held[0]) // 2 >= self.pre_roll:
+                self.held_samples -= len(self.held.popleft()) // 2
+            self.skipped += 1
+            return ()
+        blocks = list(self.held)
+        blocks.append(block)
+        self.held.clear()
+        self.held_samples = 0
+        self.passed += 1
+        return blocks
+
+class KeywordMatcher:
+    """
+    finds command phrases in recognised text, in order
+
+    phrases are indexed by their first word, longest first, so a lookup
+    costs one dict hit per word of text however many phrases there are.
+    only whole words match ("remove" is not "move"), matches do not overlap
+    and the longest phrase at a word wins ("move back" over "move").
+    """
+
+    def __init__(self, phrases):
+        self.index = {}
+        for phrase, command in phrases.items():
+            words = tuple(phrase.split())
+            self.index.setdefault(words[0], []).append((words, command))
+        for entries in self.index.values():
+            entries.sort(key=lambda entry: -len(entry[0]))
+
+    def commands(self, text):
+        return [command for command, _, _ in self.matches(text.split())]
+
+    def matches(self, words):
+        """
+        (command, start, end) of each phrase found in a list of words
+        """
+        found = []
+        i = 0
+        while i < len(words):
+            for phrase, command in self.index.get(words[i], ()):
+                if len(phrase) == 1 or tuple(words[i:i + len(phrase)]) == phrase:
+                    found.append((command, i, i + len(phrase)))
+                    i += len(phrase)
+                    break
+            else:
+                i += 1
+        return found
+
+    def may_grow(self, words):
+        """
+        whether a longer phrase starts with these words ("move" and "move back")
+        """
+        words = tuple(words)
+        return any(len(phrase) > len(words) and phrase[:len(words)] == words
+                   for phrase, _ in self.index.get(words[0], ()))
+
+def keyword_grammar(keywords, skip=()):
+    """
+    vosk grammar of the given keywords, anything else decodes as [unk]
+    """
+    return sorted(k for k in keywords if k not in skip) + ["[unk]"]
+
+def make_recognizer(model, grammar=None, rate=16000):
+    from vosk import KaldiRecognizer
+    if grammar:
+        return KaldiRecognizer(model, rate, json.dumps(grammar))
+    return KaldiRecognizer(model, rate)
+
+class PartialText(str):
+    """
+    text of an unfinished utterance, on a results queue next to final texts
+    """
+
+def kws_worker(ring_name, capacity, ready, stop, results, model_path, grammar=None, partial=False):
+    """
+    recognizer process: decode audio from the ring, put finished
+    utterances on results, and if `partial` the partial text after every
+    read that does not finish one
+    """
+    ring = AudioRing(capacity, ring_name)
+    rec = make_recognizer(load_vosk_model(model_path), grammar)
+    try:
+        while not stop.is_set():
+            if not ready.acquire(timeout=0.5):
+                continue
+            data = ring.read()
+            if not data:
+                continue
+            if rec.AcceptWaveform(data):
+                results.put(json.loads(rec.Result()).get("text", "").lower())
+            elif partial:
+                results.put(PartialText(json.loads(rec.PartialResult()).get("partial", "").lower()))
+    finally:
+        ring.close()
+
 class OfflineKeywordListener:
 
     def __init__(self,controller):
@@ -125,67 +542,409 @@ class OfflineKeywordListener:
         self.pub_tail = self.pub_head
 
         # 加载离线语音识别模型（路径根据你本地情况修改）
-        self.model = Model(r"/home/mima123/vosk-model")
-        self.rec = KaldiRecognizer(self.model, 16000)
+        # the model and the audio stream are loaded by load(), on the listener
+        # thread, so the control loop does not wait for them
+        self.model_path = r"/home/mima123/vosk-model"
+        self.model = None
+        self.rec = None
+        self.stream = None
+        self.loaded = threading.Event()
+        self.loaded_at = None
+        self.load_time = None
 
         self.triggered = False
+        self.trigger_timer = None
 
         # 关键词到动作的映射  
-        self.keyword_actions = {
-            "hello": lambda:controller.audio_judge("hello"),
-            "left": lambda:controller.audio_judge("left"),
-            "right": lambda:controller.audio_judge("right"),
-            "move": lambda:controller.audio_judge("move"),
-            "more": lambda:controller.audio_judge("move"),
-            "back": lambda:controller.audio_judge("back"),
-            "circle": lambda:controller.audio_judge("round"),
-            "dance": lambda:controller.audio_judge("dance"),
+        # spoken word or phrase -> controller.audio_judge command. one
+        # utterance can hold several ("left then dance"), run in order
+        self.keyword_commands = {
+            "hello": "hello",
+            "left": "left",
+            "right": "right",
+            "move": "move",
+            "more": "move",
+            "back": "back",
+            "move back": "back",
+            "go back": "back",
+            "round": "round",
+            "circle": "round",
+            "turn around": "round",
+            "dance": "dance",
             # "mirror": self.action_shake_head,
             # "hello": self.action_nod,
             # "shake": self.action_shake_tail,
         }
+        self.matcher = KeywordMatcher(self.keyword_commands)
+
+        # when set, audio blocks are handed over here instead of decoded inline
+        self.on_block = None
+
+        # SensorRecorder, if recording
+        self.recorder = None
+
+        # ~kws_grammar: only let the decoder search the keywords above (plus
+        # [unk] for everything else) instead of the open vocabulary. much
+        # cheaper and fewer near misses; models with a static graph ignore it.
+        # "more" is left out, it is only there for the open vocabulary
+        # hearing "move" as "more"
+        self.grammar = None
+        if rospy.get_param("~kws_grammar", False):
+            self.grammar = keyword_grammar(self.keyword_commands, skip={"more"})
+
+        # ~kws_fast: low latency mode. small audio blocks (~kws_block samples),
+        # a keyword acts as soon as it is in ~kws_stable partial results in a
+        # row, and the final result then confirms it or withdraws the action
+        self.controller = controller
+        self.fast = rospy.get_param("~kws_fast", False)
+        self.blocksize = rospy.get_param("~kws_block", 800 if self.fast else 8000)
+        self.stable_partials = rospy.get_param("~kws_stable", 2)
+        self.partial_keyword = None
+        self.partial_count = 0
+        self.provisional = None  # (keyword, what its action returned)
+
+        # ~vad: only audio the VoiceGate takes for speech reaches the
+        # recognizer, so it idles while nobody talks
+        self.gate = None
+        if rospy.get_param("~vad", False):
+            self.gate = VoiceGate(hangover=rospy.get_param("~vad_hangover", 0.8))
+
+        # the audio callback only copies blocks into a preallocated ring
+        # (2 s of audio); a decode thread drains it, so capture never waits
+        # for recording, the gate or recognition. ~kws_decode_thread false
+        # does everything on the callback instead. not used when decoding
+        # inline under --async, AsyncRuntime already takes the blocks off the
+        # callback through on_block; load() decides
+        self.decode_audio = rospy.get_param("~kws_decode_thread", True)
+        self.capture = None
+        self.decode_thread = None
+
+        # PortAudio callback status counters
+        self.overflows = 0
+        self.underflows = 0
+
+        # recognised text arrives on self.results when decoding happens
+        # elsewhere; None means decode inline
+        self.results = None
+
+        # ~kws_server: use the shared model of a running kws_server.py
+        # (true for its default socket, or a socket path); ~kws_process:
+        # decode in a worker process so recognition never competes with the
+        # control loop for the GIL
+        self.worker = None
+        self.ring = None
+        self.remote = None
+        kws_server = rospy.get_param("~kws_server", "")
+        if kws_server:
+            self.connect_server(kws_server)
+        if self.remote is None and rospy.get_param("~kws_process", False):
+            self.start_worker(self.model_path, self.grammar, self.fast)
+
+    def start_worker(self, model_path, grammar=None, partial=False, capacity=128000):
+        # fork, so the worker does not re-import this script and start a
+        # second ROS node; it only touches the ring, the queue and vosk
+        ctx = multiprocessing.get_context("fork")
+        self.ring = AudioRing(capacity)
+        self.ready = ctx.Semaphore(0)
+        self.stop = ctx.Event()
+        self.results = ctx.Queue()
+        self.worker = ctx.Process(
+            target=kws_worker, name="kws", daemon=True,
+            args=(self.ring.name, capacity, self.ready, self.stop, self.results, model_path, grammar, partial))
+        self.worker.start()
+        atexit.register(self.stop_worker)
+        rospy.loginfo("keyword recognition in process %d", self.worker.pid)
+
+    def connect_server(self, path):
+        from kws_server import KwsClient, DEFAULT_SOCKET
+        if path is True:
+            path = DEFAULT_SOCKET
+        try:
+            # partials are queued with the final texts, so both are handled
+            # in order on the listener thread
+            self.remote = KwsClient.connect(path).open(
+                {"rate": 16000, "grammar": self.grammar, "partial": self.fast},
+                on_partial=lambda text: self.results.put(PartialText(text)))
+        except OSError as e:
+            rospy.logwarn("kws server %s unavailable (%s), loading the model here", path, e)
+            return
+        self.results = self.remote.results
+        atexit.register(self.remote.close)
+        rospy.loginfo("keyword recognition on kws server %s", path)
+
+    def stop_worker(self):
+        if self.worker is None:
+            return
+        self.stop.set()
+        self.worker.join(timeout=1.0)
+        if self.ring.dropped:
+            rospy.logwarn("audio ring full, %d blocks dropped", self.ring.dropped)
+        self.ring.close(unlink=True)
+        self.worker = None
+
+    def next_text(self, timeout=0.5):
+        """
+        next utterance from the worker process or the kws server, None on
+        timeout. partial texts are handled here and not returned
+        """
+        try:
+            text = self.results.get(timeout=timeout)
+        except queue.Empty:
+            return None
+        if self.remote is not None and (text is None or isinstance(text, Exception)):
+            self.fall_back(text or "connection lost")
+            return None
+        if isinstance(text, PartialText):
+            self.handle_partial(text)
+            return None
+        return text
+
+    def fall_back(self, reason):
+        """
+        the kws server refused the session or went away: load the model
+        here and decode inline from now on
+        """
+        rospy.logwarn("kws server: %s, loading the model here", reason)
+        self.model = load_vosk_model(self.model_path)
+        self.rec = make_recognizer(self.model, self.grammar)
+        self.remote = None
+        self.results = None
+
+    def load(self):
+        if self.loaded.is_set():
+            return
+        t0 = time.monotonic()
+        if self.results is None:
+            self.model = load_vosk_model(self.model_path)
+            self.rec = make_recognizer(self.model, self.grammar)
 
         # 配置音频输入流
+        import sounddevice as sd
         self.stream = sd.RawInputStream(
             samplerate=16000,
-            blocksize=8000,
+            blocksize=self.blocksize,
             dtype='int16',
             channels=1,
             callback=self.audio_callback
         )
-
-        rospy.loginfo("🎤 离线语音识别已启动，关键词有：%s", ", ".join(self.keyword_actions.keys()))
+        # on_block only takes blocks off the callback when decoding inline
+        if (self.decode_audio and self.decode_thread is None
+                and (self.on_block is None or self.results is not None)):
+            self.capture = AudioRing(64000)
+            self.captured = threading.Semaphore(0)
+            atexit.register(self.capture.close, unlink=True)
+            self.decode_thread = threading.Thread(target=self.decode_loop, name="kws-decode", daemon=True)
+            self.decode_thread.start()
+        self.loaded_at = time.monotonic()
+        self.load_time = self.loaded_at - t0
+        self.loaded.set()
+
+        rospy.loginfo("🎤 离线语音识别已启动，关键词有：%s", ", ".join(self.keyword_commands))
 
     def run(self):
+        self.load()
         with self.stream:
-            rospy.spin()
+            while not rospy.core.is_shutdown():
+                if self.results is None:
+                    rospy.spin()
+                    return
+                text = self.next_text()
+                if text is not None:
+                    self.handle_text(text)
 
     def audio_callback(self, indata, frames, time, status):
-        if self.rec.AcceptWaveform(bytes(indata)):
+        if status:
+            if status.input_overflow:
+                self.overflows += 1
+                LOG.log(SITE_OVERFLOW, self.overflows)
+            if status.input_underflow:
+                self.underflows += 1
+        if self.capture is None:
+            self.process(indata)
+        elif self.capture.write(indata):
+            self.captured.release()
+
+    def decode_loop(self):
+        while not rospy.core.is_shutdown():
+            if self.captured.acquire(timeout=0.5):
+                self.drain()
+
+    def drain(self):
+        # everything captured since the last drain, as one block
+        data = self.capture.read()
+        if data:
+            self.process(data)
+
+    def audio_report(self):
+        report = {"overflows": self.overflows, "underflows": self.underflows}
+        if self.capture is not None:
+            report["capture_dropped"] = self.capture.dropped
+        if self.gate is not None:
+            report["gate_passed"] = self.gate.passed
+            report["gate_skipped"] = self.gate.skipped
+        return report
+
+    def process(self, indata):
+        if self.recorder is not None:
+            self.recorder.audio(indata)
+        if self.gate is None:
+            self.feed(indata)
+            return
+        for block in self.gate.process(indata):
+            self.feed(block)
+
+    def feed(self, indata):
+        if self.worker is not None:
+            if self.ring.write(indata):
+                self.ready.release()
+            return
+        if self.remote is not None:
+            # a lost server shows up on results, next_text() falls back
+            self.remote.feed(indata)
+            return
+        if self.on_block is not None:
+            self.on_block(bytes(indata))
+            return
+        text = self.decode(bytes(indata))
+        if text is not None:
+            self.handle_text(text)
+
+    def decode(self, data):
+        """
+        feed one block to the recognizer, return the text of a finished
+        utterance or None
+        """
+        if self.rec.AcceptWaveform(data):
             result = self.rec.Result()
-            text = json.loads(result).get("text", "").lower()
-            rospy.loginfo("🧪 识别文本: %s", text)
-
-            if not self.triggered:
-                for keyword, action_fn in self.keyword_actions.items():
-                    if keyword in text:
-                        rospy.loginfo(f"🗣️ 识别到关键词：{keyword}")
-                        self.triggered = True
-                        action_fn()
-                        rospy.Timer(rospy.Duration(3.0), self.reset_trigger, oneshot=True)
-                        break
+            return json.loads(result).get("text", "").lower()
+        if self.fast:
+            self.handle_partial(json.loads(self.rec.PartialResult()).get("partial", "").lower())
+        return None
+
+    def trigger(self, commands):
+        self.triggered = True
+        result = self.controller.audio_sequence(commands)
+        self.trigger_timer = rospy.Timer(rospy.Duration(3.0), self.reset_trigger, oneshot=True)
+        return result
+
+    def handle_partial(self, text):
+        """
+        act on a keyword once it has been in enough partial results in a row
+        """
+        words = text.split()
+        matches = self.matcher.matches(words)
+        keyword = None
+        if matches:
+            keyword, start, end = matches[0]
+            # a match that ends the partial may still become a longer
+            # phrase ("move" then "move back"): wait for more words
+            if end == len(words) and self.matcher.may_grow(words[start:end]):
+                keyword = None
+        if keyword is None or keyword != self.partial_keyword:
+            self.partial_keyword = keyword
+            self.partial_count = 0
+        if keyword is None:
+            return
+        self.partial_count += 1
+        if (self.partial_count >= self.stable_partials
+                and self.provisional is None and not self.triggered):
+            LOG.log(SITE_EARLY, keyword)
+            self.provisional = (keyword, self.trigger([keyword]))
+
+    def handle_text(self, text):
+        LOG.log(SITE_TEXT, text)
+        self.partial_keyword = None
+        self.partial_count = 0
+        commands = self.matcher.commands(text)
+
+        if self.provisional is not None:
+            keyword, result = self.provisional
+            self.provisional = None
+            if commands[:1] == [keyword]:
+                LOG.log(SITE_CONFIRM, keyword)
+                # the rest of the utterance runs after the early command
+                if len(commands) > 1:
+                    self.controller.audio_sequence(commands[1:], after=result)
+                return
+            # the final text disagrees with the partials: take the action
+            # back and let the final text trigger instead
+            LOG.log(SITE_WITHDRAW, keyword, text)
+            self.controller.audio_withdraw(result)
+            self.trigger_timer.shutdown()
+            self.triggered = False
+
+        if not self.triggered and commands:
+            LOG.log(SITE_KEYWORD, ", ".join(commands))
+            self.trigger(commands)
 
     def reset_trigger(self, event):
         self.triggered = False
 
+class SensorSnapshot:
+    """
+    sequence-numbered double buffer of the latest sensor values
+
+    callbacks write into the back slot under a writers' lock and then bump
+    seq, which makes it the front one. the control loop reads without a
+    lock: it copies the front slot and checks seq did not move meanwhile,
+    retrying if a write flipped the buffers under it. one read per tick
+    gives the whole tick one consistent view.
+    """
+
+    FIELDS = ("package", "package_time", "sonar_distance", "cliff_left", "cliff_right", "cliff_time")
+
+    def __init__(self, clock=None):
+        self.clock = clock or time.monotonic
+        initial = dict.fromkeys(self.FIELDS)
+        # no sonar reading yet is None, no cliff reading -1
+        initial.update(cliff_left=-1, cliff_right=-1)
+        self.slots = [initial, dict(initial)]
+        self.seq = 0
+        self.write_lock = threading.Lock()
+        self.retries = 0
+
+    def update(self, **values):
+        with self.write_lock:
+            back = self.slots[(self.seq + 1) & 1]
+            back.update(self.slots[self.seq & 1])
+            back.update(values)
+            self.seq += 1
+
+    def read(self):
+        """
+        (seq, copy of the latest values)
+        """
+        while True:
+            seq = self.seq
+            values = self.slots[seq & 1].copy()
+            if self.seq == seq:
+                return seq, values
+            self.retries += 1
+
 class MiroSensors:
-    def __init__(self):
-        self.sonar_distance = 0
+    def __init__(self, robot_name=None, snapshot=None):
+        # tick-local copies, set from the snapshot by load()
+        self.sonar_distance = None
         self.cliff_left = -1
         self.cliff_right = -1
         self.cliff_flag =None
-     
-        topic_base_name = "/" + os.getenv("MIRO_ROBOT_NAME")
+
+        # callbacks only write here
+        self.snapshot = snapshot or SensorSnapshot()
+
+        # when set, callbacks hand their message to dispatch(handler, msg)
+        # instead of applying it on the rospy thread
+        self.dispatch = None
+
+        # when set (LatencyTracer), arrival stamps of the latest messages
+        self.tracer = None
+        self.sonar_stamp = None
+        self.cliff_stamp = None
+
+        # SensorRecorder, if recording
+        self.recorder = None
+
+        topic_base_name = "/" + (robot_name or os.getenv("MIRO_ROBOT_NAME"))
         topic = topic_base_name + "/sensors/package"
         rospy.Subscriber(topic, miro.msg.sensors_package, self.sonar_callback,
                          queue_size=1, tcp_nodelay=True)
@@ -196,14 +955,35 @@ class MiroSensors:
         rospy.loginfo(f"[MiroSensors] Subscribing to {topic}")
 
     def sonar_callback(self,msg):
-        self.sonar_distance = msg.sonar.range
+        if self.tracer is not None:
+            self.sonar_stamp = self.tracer.stamp(msg)
+        if self.dispatch is not None:
+            self.dispatch(self.store_sonar, msg)
+            return
+        self.store_sonar(msg)
+
+    def store_sonar(self, msg):
+        self.snapshot.update(sonar_distance=msg.sonar.range)
 
     def cliff_callback(self,msg):
-        
-        self.cliff_left = msg.data[0]
-        self.cliff_right = msg.data[1]
-        print(self.cliff_right)
-        print(self.cliff_left)
+        if self.recorder is not None:
+            self.recorder.cliff(msg)
+        if self.tracer is not None:
+            self.cliff_stamp = self.tracer.stamp(msg)
+        if self.dispatch is not None:
+            self.dispatch(self.store_cliff, msg)
+            return
+        self.store_cliff(msg)
+
+    def store_cliff(self, msg):
+        self.snapshot.update(cliff_left=msg.data[0], cliff_right=msg.data[1],
+                             cliff_time=self.snapshot.clock())
+        LOG.log(SITE_CLIFF, msg.data[1], msg.data[0])
+
+    def load(self, values):
+        self.sonar_distance = values["sonar_distance"]
+        self.cliff_left = values["cliff_left"]
+        self.cliff_right = values["cliff_right"]
 
     def get_sonar_distance(self):
 
@@ -220,6 +1000,1182 @@ class MiroSensors:
             else:
                 self.cliff_flag  =  "cliff_safe"
 
+class DeadlineScheduler:
+    """
+    fixed-rate tick pacing on a monotonic clock
+
+    tick k is due at t_start + k * period, so the time spent inside a tick
+    does not stretch the period. when a tick runs past the next deadline
+    the overrun policy decides what happens:
+      "skip"    - drop the missed ticks and wait for the next future deadline
+      "catchup" - run the missed ticks back to back until on time again
+    """
+
+    def __init__(self, period=0.02, policy="skip", clock=None, sleep=None):
+        if policy not in ("skip", "catchup"):
+            raise ValueError(f"unknown overrun policy: {policy}")
+        self.period = period
+        self.policy = policy
+        self.clock = clock or time.monotonic
+        self.sleep = sleep or time.sleep
+
+        self.tick = 0
+        self.t_start = None
+
+        # overrun counters
+        self.overruns = 0
+        self.skipped_ticks = 0
+        self.last_lateness = 0.0
+        self.max_lateness = 0.0
+
+    def start(self):
+        self.t_start = self.clock()
+        self.tick = 0
+        return self.tick
+
+    def deadline(self, tick):
+        return self.t_start + tick * self.period
+
+    def wait(self):
+        """
+        block until the next tick is due and return its index
+        """
+        tick, delay = self.next()
+        if delay > 0.0:
+            self.sleep(delay)
+        return tick
+
+    def next(self):
+        """
+        move on to the next tick, return its index and the time until it is
+        due; for callers that do their own waiting (asyncio)
+        """
+        if self.t_start is None:
+            return self.start(), 0.0
+
+        next_tick = self.tick + 1
+        now = self.clock()
+        lateness = now - self.deadline(next_tick)
+        self.last_lateness = lateness
+
+        if lateness > 0.0:
+            self.overruns += 1
+            if lateness > self.max_lateness:
+                self.max_lateness = lateness
+            if self.policy == "skip":
+                # jump to the first deadline that is still in the future
+                due = int((now - self.t_start) // self.period) + 1
+                self.skipped_ticks += due - next_tick
+                next_tick = due
+            else:
+                # catch up: run the overdue tick immediately
+                self.tick = next_tick
+                return self.tick, 0.0
+
+        self.tick = next_tick
+        return self.tick, self.deadline(next_tick) - self.clock()
+
+    def stats(self):
+        return {
+            "tick": self.tick,
+            "overruns": self.overruns,
+            "skipped_ticks": self.skipped_ticks,
+            "max_lateness": self.max_lateness,
+        }
+
+def build_illum_shine_words():
+    # packed 0xAARRGGBB words for every shine level q, as illum_Shine lays them out
+    q = np.arange(256, dtype=np.uint32)[:, None]
+    shift = np.array([16, 8, 0, 0, 8, 16], dtype=np.uint32)[None, :]
+    return (q << shift) | np.uint32(0xFF000000)
+
+ILLUM_SHINE_WORDS = build_illum_shine_words().tolist()
+
+class OscillatorBank:
+    """
+    table-driven xk / xc / xcc / xc2 waveforms
+
+    each oscillator advances by an exact fraction n / L of a cycle per tick,
+    so its phase is an integer index into a precomputed period table of
+    length L. integer phase never drifts, however long the run. L is capped
+    at MAX_PERIOD ticks, which quantises a frequency to within a few
+    microhertz and bounds every table. changing a frequency maps the current
+    index onto the new table, so the waveform continues from the same point
+    of its cycle.
+
+    the kin table holds xk. the cos table spans one cycle of xc2 (two of
+    xc) and holds the waveforms derived from f_cos in one row: xc, xcc, xc2
+    """
+
+    XC, XCC, XC2 = range(3)
+
+    MAX_PERIOD = 3000
+
+    # tables depend only on their length, so every bank shares them; only
+    # the most recent few lengths are kept
+    tables = {}
+    MAX_TABLES = 16
+
+    def __init__(self, period=0.02, f_kin=0.25, f_cos=1.0):
+        self.period = period
+        self.f_kin = None
+        self.f_cos = None
+        self.kin_phase = 0
+        self.cos_phase = 0
+        self.kin_len = 1
+        self.cos_len = 1
+        self.set_frequency(f_kin, f_cos)
+
+    def step(self, freq, cycles_per_tick):
+        # cycles advanced per tick as a fraction n / L, L <= MAX_PERIOD
+        step = Fraction(freq * self.period * cycles_per_tick).limit_denominator(self.MAX_PERIOD)
+        if step <= 0:
+            raise ValueError(f"oscillator frequency must be positive: {freq}")
+        return step.numerator, step.denominator
+
+    def table(self, kind, length):
+        key = (kind, length)
+        rows = self.tables.get(key)
+        if rows is None:
+            w = 2.0 * np.pi * np.arange(length) / length
+            if kind == "kin":
+                rows = np.sin(w).tolist()
+            else:
+                rows = np.stack([np.sin(2.0 * w), np.cos(2.0 * w), np.sin(w)], axis=1).tolist()
+            if len(self.tables) >= self.MAX_TABLES:
+                del self.tables[next(iter(self.tables))]
+            self.tables[key] = rows
+        return rows
+
+    def set_frequency(self, f_kin, f_cos):
+        if f_kin != self.f_kin:
+            n, length = self.step(f_kin, 1.0)
+            self.kin_phase = (self.kin_phase * length + self.kin_len // 2) // self.kin_len % length
+            self.kin_step, self.kin_len = n, length
+            self.kin_rows = self.table("kin", length)
+            self.f_kin = f_kin
+        if f_cos != self.f_cos:
+            # the cos table spans one cycle of xc2, which runs at f_cos / 2
+            n, length = self.step(f_cos, 0.5)
+            self.cos_phase = (self.cos_phase * length + self.cos_len // 2) // self.cos_len % length
+            self.cos_step, self.cos_len = n, length
+            self.cos_rows = self.table("cos", length)
+            self.f_cos = f_cos
+        # periodic timelines are laid out from this point of both cycles
+        self.origin = (self.kin_phase, self.cos_phase)
+        self.ticks = 0
+        self.cycle = self.kin_len * self.cos_len // math.gcd(self.kin_len, self.cos_len)
+
+    def advance(self, ticks=1):
+        self.kin_phase = (self.kin_phase + self.kin_step * ticks) % self.kin_len
+        self.cos_phase = (self.cos_phase + self.cos_step * ticks) % self.cos_len
+        self.ticks += ticks
+
+    def sample(self):
+        """
+        return xk and the cos row for the current tick
+        """
+        return self.kin_rows[self.kin_phase], self.cos_rows[self.cos_phase]
+
+    def clone(self, phases=(0, 0)):
+        """
+        an independent bank with the same frequencies, started at `phases`
+        """
+        bank = OscillatorBank(self.period, self.f_kin, self.f_cos)
+        bank.kin_phase, bank.cos_phase = phases
+        bank.origin = phases
+        return bank
+
+# column layout of a compiled timeline row
+KIN_COLS = range(0, 4)       # msg_kin.position
+COS_COLS = range(4, 10)      # msg_cos.data
+ILLUM_COLS = range(10, 16)   # msg_illum.data
+WHEEL_COLS = range(16, 18)   # twist.linear.x, twist.angular.z
+N_CHANNELS = 18
+
+# bump when the row layout or the compile step changes
+TIMELINE_VERSION = 1
+
+class CapturePublisher:
+    """
+    publisher stand-in used while compiling, keeps the last message
+    """
+
+    def __init__(self):
+        self.msg = None
+
+    def publish(self, msg):
+        self.msg = msg
+
+class Timeline:
+    """
+    a behaviour compiled to one row per tick, one column per actuator channel
+
+    only the channels the behaviour writes are played back, the others are
+    left to whoever else drives them.
+    """
+
+    def __init__(self, name, table, mask):
+        self.name = name
+        self.table = table
+        self.mask = mask
+        self.length = len(table)
+
+        cols = np.flatnonzero(mask).tolist()
+        self.kin = [(c - KIN_COLS.start, c) for c in cols if c in KIN_COLS]
+        self.cos = [(c - COS_COLS.start, c) for c in cols if c in COS_COLS]
+        self.illum = [(c - ILLUM_COLS.start, c) for c in cols if c in ILLUM_COLS]
+        self.wheels = any(c in WHEEL_COLS for c in cols)
+
+        self.rows = table.tolist()
+        for row in self.rows:
+            for _, c in self.illum:
+                row[c] = int(row[c])
+
+    def play(self, ctrl, i):
+        """
+        write row i (wrapping) into the controller's messages and publish
+        """
+        self.play_motion(ctrl, i)
+        self.play_cos(ctrl, i)
+        self.play_illum(ctrl, i)
+
+    # the channel groups on their own, for subsystems that run at their own rate
+
+    def play_motion(self, ctrl, i):
+        # head joints and wheels
+        row = self.rows[i % self.length]
+        if self.kin:
+            position = ctrl.msg_kin.position
+            for j, c in self.kin:
+                position[j] = row[c]
+            ctrl.pub_kin.publish(ctrl.msg_kin)
+        if self.wheels:
+            twist = ctrl.msg_spin.twist
+            twist.linear.x = row[WHEEL_COLS.start]
+            twist.angular.z = row[WHEEL_COLS.start + 1]
+            ctrl.pub_wheels.publish(ctrl.msg_spin)
+
+    def play_cos(self, ctrl, i):
+        if self.cos:
+            row = self.rows[i % self.length]
+            data = ctrl.msg_cos.data
+            for j, c in self.cos:
+                data[j] = row[c]
+            ctrl.pub_cos.publish(ctrl.msg_cos)
+
+    def play_illum(self, ctrl, i):
+        if self.illum:
+            row = self.rows[i % self.length]
+            data = ctrl.msg_illum.data
+            for j, c in self.illum:
+                data[j] = row[c]
+            ctrl.pub_illum.publish(ctrl.msg_illum)
+
+class TimelineCompiler:
+    """
+    compiles controller behaviours into Timelines
+
+    a behaviour is any controller method called as behaviour(xk, xc, xc2, xcc)
+    that drives the actuators through the usual helpers. compiling runs it
+    once per tick against capture publishers and records the channels it
+    writes. timelines are cached in memory and, keyed by the script source,
+    the frequencies and the start phase, as .npz files in cache_dir.
+
+    compiling runs on a copy of the controller with its own messages, so a
+    loop needed mid-run is compiled on a background thread while the caller
+    keeps evaluating the behaviour directly.
+    """
+
+    # compiled timelines, shared by every controller in the process; the
+    # least recently used go once there are MAX_TIMELINES
+    cache = {}
+    MAX_TIMELINES = 32
+    lock = threading.Lock()
+    source_hash = None
+
+    # longer oscillator cycles are not compiled, they play directly
+    MAX_LOOP = 3000
+
+    # loops being compiled in the background, by cache key
+    pending = {}
+    pool = None
+
+    def __init__(self, ctrl, cache_dir=None):
+        self.ctrl = ctrl
+        self.cache_dir = cache_dir
+        if TimelineCompiler.source_hash is None:
+            TimelineCompiler.source_hash = ""
+            try:
+                with open(os.path.abspath(__file__), "rb") as f:
+                    TimelineCompiler.source_hash = hashlib.sha1(f.read()).hexdigest()
+            except (NameError, OSError):
+                pass
+
+    def compile(self, name, behaviour, n_ticks, osc):
+        """
+        timeline of n_ticks rows, sampling the oscillators from osc's phase
+        """
+        key = (name, n_ticks, osc.period, osc.f_kin, osc.f_cos,
+               osc.kin_phase, osc.cos_phase, self.source_hash, TIMELINE_VERSION)
+        timeline = self.cached(key)
+        if timeline is not None:
+            return timeline
+
+        path = None
+        if self.cache_dir:
+            digest = hashlib.sha1(repr(key).encode()).hexdigest()[:16]
+            path = os.path.join(self.cache_dir, f"{name}-{digest}.npz")
+            try:
+                with np.load(path) as f:
+                    timeline = Timeline(name, f["table"], f["mask"])
+            except (OSError, KeyError, ValueError):
+                timeline = None
+
+        if timeline is None:
+            table, mask = self.evaluate(behaviour, n_ticks, osc)
+            timeline = Timeline(name, table, mask)
+            if path is not None:
+                try:
+                    os.makedirs(self.cache_dir, exist_ok=True)
+                    tmp = f"{path}.{os.getpid()}.tmp.npz"
+                    np.savez(tmp, table=table, mask=mask)
+                    os.replace(tmp, path)
+                except OSError as e:
+                    rospy.logwarn(f"timeline cache not written: {e}")
+
+        return self.remember(key, timeline)
+
+    def cached(self, key):
+        with self.lock:
+            timeline = self.cache.pop(key, None)
+            if timeline is not None:
+                self.cache[key] = timeline
+        return timeline
+
+    def remember(self, key, timeline):
+        with self.lock:
+            self.cache.pop(key, None)
+            while len(self.cache) >= self.MAX_TIMELINES:
+                del self.cache[next(iter(self.cache))]
+            self.cache[key] = timeline
+        return timeline
+
+    def loop(self, name, behaviour, osc, wait=False):
+        """
+        periodic timeline spanning one full oscillator cycle from osc.origin,
+        play it with index osc.ticks. None while it is compiling in the
+        background, or if the cycle is longer than MAX_LOOP ticks; wait
+        compiles it here instead
+        """
+        # looked up every tick, so only clone the bank when it is not compiled yet
+        key = ("loop", name, osc.period, osc.f_kin, osc.f_cos, osc.origin)
+        timeline = self.cached(key)
+        if timeline is not None or osc.cycle > self.MAX_LOOP:
+            return timeline
+        if wait:
+            return self.remember(key, self.compile(name, behaviour, osc.cycle, osc.clone(osc.origin)))
+        if key not in self.pending:
+            if TimelineCompiler.pool is None:
+                TimelineCompiler.pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="timelines")
+            future = self.pending[key] = self.pool.submit(
+                self.compile_loop, key, name, behaviour, osc.cycle, osc.clone(osc.origin))
+            # runs at once if the compile already finished
+            future.add_done_callback(lambda f: self.pending.pop(key, None))
+        return None
+
+    def compile_loop(self, key, name, behaviour, n_ticks, osc):
+        try:
+            self.remember(key, self.compile(name, behaviour, n_ticks, osc))
+        except Exception as e:
+            rospy.logwarn(f"timeline {name} not compiled: {e}")
+
+    def shadow(self):
+        """
+        a copy of the controller with its own messages and capture
+        publishers, for behaviours to write into while compiling
+        """
+        ctrl = copy.copy(self.ctrl)
+        for name in ("msg_kin", "msg_cos", "msg_illum", "msg_spin", "msg_wheels"):
+            setattr(ctrl, name, copy.deepcopy(getattr(self.ctrl, name)))
+        ctrl.pub_kin = ctrl.pub_cos = ctrl.pub_illum = ctrl.pub_push = CapturePublisher()
+        ctrl.pub_wheels = CapturePublisher()
+        return ctrl
+
+    def evaluate(self, behaviour, n_ticks, osc):
+        ctrl = self.shadow()
+        if getattr(behaviour, "__self__", None) is self.ctrl:
+            behaviour = behaviour.__func__.__get__(ctrl)
+        wheels = ctrl.pub_wheels
+        nan = float("nan")
+
+        table = np.full((n_ticks, N_CHANNELS), np.nan)
+        for i in range(n_ticks):
+            xk, row = osc.sample()
+            xc, xcc, xc2 = row
+
+            # channels still NaN after the call were not written this tick
+            ctrl.msg_kin.position[:] = [nan] * len(KIN_COLS)
+            ctrl.msg_cos.data[:] = [nan] * len(COS_COLS)
+            ctrl.msg_illum.data[:] = [nan] * len(ILLUM_COLS)
+            wheels.msg = None
+
+            behaviour(xk, xc, xc2, xcc)
+
+            table[i, KIN_COLS.start:KIN_COLS.stop] = ctrl.msg_kin.position
+            table[i, COS_COLS.start:COS_COLS.stop] = ctrl.msg_cos.data
+            table[i, ILLUM_COLS.start:ILLUM_COLS.stop] = ctrl.msg_illum.data
+            if wheels.msg is not None:
+                twist = wheels.msg.twist
+                table[i, WHEEL_COLS.start:WHEEL_COLS.stop] = (twist.linear.x, twist.angular.z)
+            osc.advance()
+
+        # a channel written on some ticks only holds its last value in
+        # between, wrapping round so the hold also covers the first rows
+        mask = ~np.all(np.isnan(table), axis=0)
+        for c in np.flatnonzero(mask & np.any(np.isnan(table), axis=0)):
+            col = table[:, c]
+            last = col[~np.isnan(col)][-1]
+            for i in range(n_ticks):
+                if np.isnan(col[i]):
+                    col[i] = last
+                else:
+                    last = col[i]
+        return table, mask
+
+# action priorities, a higher priority pre-empts a lower one
+PRIORITY_COMMAND = 1
+PRIORITY_SONAR = 2
+PRIORITY_CLIFF = 3
+
+class TimedAction:
+    """
+    an actuator behaviour that runs for a number of ticks
+
+    step() drives the actuators on every tick of the action, finish() runs
+    once when it ends, whether it completed or was cancelled. the action
+    ends after `duration` ticks or as soon as until() returns True.
+    resources name the actuators the action drives; starting an action
+    pre-empts running actions of equal or lower priority on the same
+    resources and is refused while a higher priority one holds them.
+    on_complete(action) is called when it runs to the end, on_cancel(action)
+    when it is pre-empted, cancelled or refused.
+    """
+
+    def __init__(self, name, duration, step, finish=None, resources=("wheels",),
+                 priority=0, until=None, on_complete=None, on_cancel=None):
+        self.name = name
+        self.duration = duration
+        self.step = step
+        self.finish = finish
+        self.resources = resources
+        self.priority = priority
+        self.until = until
+        self.on_complete = on_complete
+        self.on_cancel = on_cancel
+
+        self.ticks = 0
+
+class TurnedThrough:
+    """
+    until() predicate that integrates the measured yaw rate and turns
+    true once the robot has turned through `angle` radians
+    """
+
+    def __init__(self, yaw_rate, dt, angle):
+        self.yaw_rate = yaw_rate
+        self.dt = dt
+        self.angle = angle
+        self.turned = 0.0
+
+    def __call__(self):
+        rate = self.yaw_rate()
+        if rate is not None:
+            self.turned += abs(rate) * self.dt
+        return self.turned >= self.angle
+
+class ActionEngine:
+    """
+    runs the active TimedActions once per tick
+
+    per-tick cost is O(active actions). request() and withdraw() may be
+    called from any thread (keyword listener, sensor callbacks); they are
+    applied at the start of the next step() on the control thread.
+    """
+
+    def __init__(self):
+        self.active = []
+        self.requests = deque()
+        self.withdrawals = deque()
+
+        # counters
+        self.started = 0
+        self.completed = 0
+        self.cancelled = 0
+        self.refused = 0
+
+    def request(self, action):
+        self.requests.append(action)
+
+    def withdraw(self, action):
+        # cancel an action passed to request(), whether it started yet or not
+        self.withdrawals.append(action)
+
+    def is_active(self, name):
+        for action in self.active:
+            if action.name == name:
+                return True
+        return False
+
+    def start(self, action):
+        """
+        start an action now, return False if a higher priority action
+        holds one of its resources
+        """
+        blockers = [a for a in self.active
+                    if any(r in a.resources for r in action.resources)]
+        for a in blockers:
+            if a.priority > action.priority:
+                self.refused += 1
+                if action.on_cancel is not None:
+                    action.on_cancel(action)
+                return False
+        for a in blockers:
+            self.end(a, completed=False)
+        self.active.append(action)
+        self.started += 1
+        return True
+
+    def cancel(self, name=None, resource=None):
+        """
+        cancel running actions by name and/or resource, None matches all
+        """
+        for action in list(self.active):
+            if name is not None and action.name != name:
+                continue
+            if resource is not None and resource not in action.resources:
+                continue
+            self.end(action, completed=False)
+
+    def end(self, action, completed):
+        self.active.remove(action)
+        if action.finish is not None:
+            action.finish()
+        if completed:
+            self.completed += 1
+            if action.on_complete is not None:
+                action.on_complete(action)
+        else:
+            self.cancelled += 1
+            if action.on_cancel is not None:
+                action.on_cancel(action)
+
+    def step(self):
+        while self.requests:
+            self.start(self.requests.popleft())
+        while self.withdrawals:
+            action = self.withdrawals.popleft()
+            if action in self.active:
+                self.end(action, completed=False)
+        for action in list(self.active):
+            action.ticks += 1
+            if action.ticks < action.duration and (action.until is None or not action.until()):
+                action.step()
+            else:
+                self.end(action, completed=True)
+
+class RateTask:
+    def __init__(self, name, fn, divisor, offset):
+        self.name = name
+        self.fn = fn
+        self.divisor = divisor
+        self.offset = offset
+
+        self.runs = 0
+        self.busy = 0.0
+
+class MultiRateExecutor:
+    """
+    runs each subsystem at its own integer division of the base tick rate
+
+    a task with divisor d runs on ticks where tick % d == offset. divisors
+    must form a harmonic chain (each one divides or is divided by every
+    other), so every rate lines up with the slowest one. without an explicit
+    offset a task is put on the least loaded slot to spread slow work out.
+    """
+
+    def __init__(self, base_period=0.02, clock=None):
+        self.base_period = base_period
+        self.clock = clock or time.perf_counter
+        self.tasks = []
+        self.hyperperiod = 1
+        self.schedule = [[]]
+        self.ticks_run = 0
+
+    def add(self, name, fn, divisor=1, offset=None):
+        for task in self.tasks:
+            if task.divisor % divisor and divisor % task.divisor:
+                raise ValueError(f"rate divisor {divisor} of {name} is not harmonic "
+                                 f"with {task.divisor} of {task.name}")
+        if offset is None:
+            load = [sum(1 for t in self.tasks if t.offset % t.divisor == slot % t.divisor)
+                    for slot in range(divisor)]
+            offset = load.index(min(load))
+        self.tasks.append(RateTask(name, fn, divisor, offset % divisor))
+
+        # tasks due on each tick of the hyperperiod
+        self.hyperperiod = max(t.divisor for t in self.tasks)
+        self.schedule = [[t for t in self.tasks if slot % t.divisor == t.offset]
+                         for slot in range(self.hyperperiod)]
+
+    def run(self, tick):
+        clock = self.clock
+        for task in self.schedule[tick % self.hyperperiod]:
+            t0 = clock()
+            task.fn()
+            task.busy += clock() - t0
+            task.runs += 1
+        self.ticks_run += 1
+
+    def utilisation(self):
+        """
+        fraction of wall time spent in the tasks of each rate, keyed by Hz
+        """
+        elapsed = self.ticks_run * self.base_period
+        report = {}
+        for task in self.tasks:
+            rate = 1.0 / (self.base_period * task.divisor)
+            report[rate] = report.get(rate, 0.0) + (task.busy / elapsed if elapsed else 0.0)
+        return report
+
+class OutputFrame:
+    """
+    collects the actuator writes made during one tick
+
+    while a frame is open, publish() on a FramedPublisher only records the
+    message; flush() then sends one message per topic. the messages are
+    shared and edited in place, so the last write in a tick always wins.
+    outside an open frame writes go straight through.
+
+    a topic given a divisor with set_divisor() is only flushed on every
+    divisor-th tick; in between its latest write stays staged.
+    """
+
+    def __init__(self):
+        self.active = False
+        self.staged = {}
+        self.divisors = {}
+
+        # LatencyTracer told about every message that is actually sent, if set
+        self.tracer = None
+
+        # counters
+        self.writes = 0
+        self.publishes = 0
+
+    def set_divisor(self, pub, divisor):
+        self.divisors[pub] = divisor
+
+    def begin(self):
+        self.active = True
+
+    def send(self, pub, msg):
+        # a ChangeSuppressedPublisher returns False when it dropped msg
+        sent = pub.publish(msg)
+        self.publishes += 1
+        if self.tracer is not None and sent is not False:
+            self.tracer.published(pub)
+
+    def stage(self, pub, msg):
+        if not self.active:
+            self.send(pub, msg)
+            return
+        self.writes += 1
+        self.staged[pub] = msg
+
+    def flush(self, tick=0):
+        held = None
+        for pub, msg in self.staged.items():
+            divisor = self.divisors.get(pub, 1)
+            if divisor > 1 and tick % divisor:
+                if held is None:
+                    held = {}
+                held[pub] = msg
+                continue
+            self.send(pub, msg)
+        self.staged.clear()
+        if held:
+            self.staged.update(held)
+        self.active = False
+
+class FramedPublisher:
+    """
+    publisher stand-in that routes publish() through an OutputFrame
+    """
+
+    def __init__(self, frame, pub):
+        self.frame = frame
+        self.pub = pub
+
+    def publish(self, msg):
+        self.frame.stage(self.pub, msg)
+
+    def __getattr__(self, name):
+        return getattr(self.pub, name)
+
+def twist_payload(msg):
+    t = msg.twist
+    return (t.linear.x, t.linear.y, t.linear.z, t.angular.x, t.angular.y, t.angular.z)
+
+def joint_payload(msg):
+    return tuple(msg.position)
+
+def array_payload(msg):
+    return tuple(msg.data)
+
+class ChangeSuppressedPublisher:
+    """
+    drops messages whose payload equals the last one sent
+
+    an unchanged payload is still resent once every `heartbeat` seconds so
+    the firmware watchdogs keep seeing traffic. heartbeat <= 0 disables
+    suppression.
+    """
+
+    def __init__(self, pub, payload, heartbeat=0.5, clock=None):
+        self.pub = pub
+        self.payload = payload
+        self.heartbeat = heartbeat
+        self.clock = clock or time.monotonic
+
+        self.last_payload = None
+        self.last_sent = None
+
+        # counters
+        self.sent = 0
+        self.suppressed = 0
+
+    def publish(self, msg):
+        """
+        send msg unless suppressed, return whether it was sent
+        """
+        key = self.payload(msg)
+        now = self.clock()
+        if (self.heartbeat > 0.0 and key == self.last_payload
+                and now - self.last_sent < self.heartbeat):
+            self.suppressed += 1
+            return False
+        self.pub.publish(msg)
+        self.last_payload = key
+        self.last_sent = now
+        self.sent += 1
+        return True
+
+    def __getattr__(self, name):
+        return getattr(self.pub, name)
+
+class LatencyHistogram:
+    """
+    log-linear histogram of durations in microseconds, HDR style
+
+    values below 64 us get a bucket each, above that every power of two is
+    split into 32 buckets, so any value is kept to within about 3% in a
+    fixed set of counters.
+    """
+
+    SIZE = 1024
+
+    def __init__(self):
+        self.counts = [0] * self.SIZE
+        self.total = 0
+        self.max = 0
+
+    @classmethod
+    def index(cls, us):
+        if us < 64:
+            return us
+        shift = us.bit_length() - 6
+        return min(64 + (shift - 1) * 32 + (us >> shift) - 32, cls.SIZE - 1)
+
+    @classmethod
+    def upper(cls, i):
+        # highest value counted in bucket i
+        if i < 64:
+            return i
+        shift = (i - 64) // 32 + 1
+        return ((((i - 64) % 32) + 32) << shift) + (1 << shift) - 1
+
+    def record(self, us):
+        self.counts[self.index(us)] += 1
+        self.total += 1
+        if us > self.max:
+            self.max = us
+
+    def percentile(self, p):
+        if not self.total:
+            return 0
+        rank = max(1, math.ceil(p * self.total))
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank:
+                return min(self.upper(i), self.max)
+        return self.max
+
+    def summary(self):
+        return {"n": self.total, "p50_us": self.percentile(0.5),
+                "p99_us": self.percentile(0.99), "max_us": self.max}
+
+class StageProfiler:
+    """
+    per-stage timing of the control tick
+
+    instrument() swaps the stage methods of one controller, its executor
+    tasks, the frame flush and the whole tick for timed wrappers. without
+    it nothing is wrapped, so profiling that is off costs nothing.
+    """
+
+    STAGES = ("Gain_Touch_flag", "touch_feel", "update_avoidance_state", "avoidance_motion")
+
+    def __init__(self, budget=0.02):
+        self.budget_us = int(budget * 1e6)
+        self.stages = {}
+        self.over_budget = {}
+
+    def timed(self, name, fn):
+        hist = self.stages.setdefault(name, LatencyHistogram())
+        self.over_budget.setdefault(name, 0)
+        over = self.over_budget
+        budget = self.budget_us
+        clock = time.perf_counter_ns
+
+        def wrapper(*args, **kwargs):
+            t0 = clock()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                us = (clock() - t0) // 1000
+                hist.record(us)
+                if us > budget:
+                    over[name] += 1
+        return wrapper
+
+    def instrument(self, ctrl):
+        for name in self.STAGES:
+            setattr(ctrl, name, self.timed(name, getattr(ctrl, name)))
+        for task in ctrl.executor.tasks:
+            task.fn = self.timed("task:" + task.name, task.fn)
+        ctrl.frame.flush = self.timed("publish", ctrl.frame.flush)
+        ctrl.control_tick = self.timed("tick", ctrl.control_tick)
+
+    def report(self):
+        report = {}
+        for name, hist in self.stages.items():
+            report[name] = hist.summary()
+            report[name]["over_budget"] = self.over_budget[name]
+        return report
+
+class Trace:
+    def __init__(self, trace_id, kind, stamp):
+        self.id = trace_id
+        self.kind = kind
+        self.stamp = stamp
+        self.reacted = False
+
+class LatencyTracer:
+    """
+    links actuator publishes to the sensor events that caused them
+
+    begin() opens a trace for a sensor event, stamped with its message
+    header stamp or, for messages without one, the arrival time. attach()
+    makes it the cause of every publish on the reaction's topics until
+    detach(). each of those publishes is logged against the trace id, and
+    the first one records the event-to-actuator latency per event kind.
+    """
+
+    def __init__(self, clock=None, history=256):
+        self.clock = clock or rospy.get_time
+        self.next_id = 1
+        self.causes = {}
+        self.latency = {}
+        self.links = deque(maxlen=history)
+
+    def stamp(self, msg):
+        header = getattr(msg, "header", None)
+        stamp = getattr(header, "stamp", None)
+        if stamp is not None and hasattr(stamp, "to_sec") and stamp.to_sec() > 0:
+            return stamp.to_sec()
+        return self.clock()
+
+    def begin(self, kind, stamp=None):
+        trace = Trace(self.next_id, kind, stamp if stamp is not None else self.clock())
+        self.next_id += 1
+        return trace
+
+    def attach(self, trace, *pubs):
+        for pub in pubs:
+            self.causes[pub] = trace
+
+    def detach(self, *pubs):
+        for pub in pubs:
+            self.causes.pop(pub, None)
+
+    def published(self, pub):
+        trace = self.causes.get(pub)
+        if trace is None:
+            return
+        now = self.clock()
+        if not trace.reacted:
+            trace.reacted = True
+            hist = self.latency.get(trace.kind)
+            if hist is None:
+                hist = self.latency[trace.kind] = LatencyHistogram()
+            hist.record(max(0, int((now - trace.stamp) * 1e6)))
+        self.links.append((trace.id, trace.kind, getattr(pub, "name", None), now))
+
+    def report(self):
+        return {"latency": {kind: hist.summary() for kind, hist in self.latency.items()},
+                "recent": list(self.links)[-16:]}
+
+# sensor log: a magic header, then chunks of one stream each. a chunk is
+# a (stream, rows, compressed size, raw size) header and the zlib of its
+# rows stored column by column; audio chunks append the raw samples.
+SENSOR_LOG_MAGIC = b"MIROLOG1"
+SENSOR_LOG_CHUNK = struct.Struct("<BIII")
+SENSOR_LOG_SESSION = struct.Struct("<d")
+LOG_PACKAGE, LOG_CLIFF, LOG_AUDIO, LOG_SESSION = 0, 1, 2, 3
+LOG_DTYPES = {
+    LOG_PACKAGE: np.dtype([("t", "f8"), ("stamp", "f8"), ("touch_head", "u2"), ("touch_body", "u2"),
+                           ("sonar", "f4"), ("yaw_rate", "f4"), ("speed", "f4")]),
+    LOG_CLIFF: np.dtype([("t", "f8"), ("left", "f4"), ("right", "f4")]),
+    LOG_AUDIO: np.dtype([("t", "f8"), ("n", "u4")]),
+}
+
+# every session starts with this header, so a reader can find the next
+# session after a torn or garbled stretch
+SENSOR_LOG_MARK = SENSOR_LOG_CHUNK.pack(LOG_SESSION, 0, SENSOR_LOG_SESSION.size, SENSOR_LOG_SESSION.size)
+
+def sensor_log_chunks(f):
+    """
+    (stream, rows, size, raw size, data offset) of each whole chunk from the
+    current position of f. a torn tail is left out, and a garbled stretch
+    (a chunk cut off by a crash, with a later session appended after it) is
+    skipped up to the next session marker
+    """
+    end = os.fstat(f.fileno()).st_size
+    pos = f.tell()
+    if pos >= end:
+        return
+    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+
+        def header(pos):
+            # the chunk at pos, None if it is torn or not a chunk
+            if pos + SENSOR_LOG_CHUNK.size > end:
+                return None
+            stream, n, size, raw_size = SENSOR_LOG_CHUNK.unpack_from(mm, pos)
+            offset = pos + SENSOR_LOG_CHUNK.size
+            if offset + size > end:
+                return None
+            if stream == LOG_SESSION:
+                if size != SENSOR_LOG_SESSION.size:
+                    return None
+            elif stream not in LOG_DTYPES or raw_size < n * LOG_DTYPES[stream].itemsize:
+                return None
+            return stream, n, size, raw_size, offset
+
+        chunk = header(pos)
+        while True:
+            if chunk is None:
+                pos = mm.find(SENSOR_LOG_MARK, pos + 1)
+                if pos < 0:
+                    return
+                chunk = header(pos)
+                continue
+            following = chunk[4] + chunk[2]
+            # a session marker starting inside the data means this chunk was
+            # torn and its stated size runs over a later session: drop it
+            # and carry on from that session
+            mark = mm.find(SENSOR_LOG_MARK, chunk[4], following + len(SENSOR_LOG_MARK) - 1)
+            if mark >= 0:
+                pos, chunk = mark, header(mark)
+                continue
+            yield chunk
+            if following >= end:
+                return
+            pos, chunk = following, header(following)
+
+class SensorRecorder:
+    """
+    append-only recording of the sensors package, cliff and microphone
+    streams as they arrive
+
+    rows are buffered per stream in a structured array and written as a
+    compressed columnar chunk whenever a buffer fills, so the callbacks
+    only copy a few fields. t is the arrival time from the start of the
+    recording; each recording appended to the file starts with a session
+    marker holding its wall-clock start time.
+    """
+
+    def __init__(self, path, chunk_rows=512, audio_rows=32, clock=None):
+        self.clock = clock or time.monotonic
+        self.t0 = self.clock()
+        self.lock = threading.Lock()
+        self.f = open(path, "ab")
+        # a recording cut off mid-chunk leaves a torn tail; cut it off so
+        # this session follows the last whole chunk
+        end = 0
+        if self.f.tell() >= len(SENSOR_LOG_MAGIC):
+            with open(path, "rb") as f:
+                if f.read(len(SENSOR_LOG_MAGIC)) != SENSOR_LOG_MAGIC:
+                    self.f.close()
+                    raise ValueError(f"{path} is not a sensor log")
+                end = len(SENSOR_LOG_MAGIC)
+                for stream, n, size, raw_size, offset in sensor_log_chunks(f):
+                    end = offset + size
+        if end < self.f.tell():
+            rospy.logwarn("%s: dropping %d bytes of a torn recording", path, self.f.tell() - end)
+            self.f.truncate(end)
+            self.f.seek(end)
+        if end == 0:
+            self.f.write(SENSOR_LOG_MAGIC)
+        self.f.write(SENSOR_LOG_MARK)
+        self.f.write(SENSOR_LOG_SESSION.pack(time.time()))
+        sizes = {LOG_PACKAGE: chunk_rows, LOG_CLIFF: chunk_rows, LOG_AUDIO: audio_rows}
+        self.buffers = {s: np.zeros(n, LOG_DTYPES[s]) for s, n in sizes.items()}
+        self.fill = dict.fromkeys(sizes, 0)
+        self.samples = []
+        self.bytes_written = 0
+        atexit.register(self.close)
+
+    def package(self, msg):
+        stamp = getattr(getattr(msg, "header", None), "stamp", None)
+        twist = getattr(getattr(getattr(msg, "odom", None), "twist", None), "twist", None)
+        self.append(LOG_PACKAGE, (
+            self.clock() - self.t0,
+            stamp.to_sec() if hasattr(stamp, "to_sec") else 0.0,
+            msg.touch_head.data, msg.touch_body.data, msg.sonar.range,
+            twist.angular.z if twist is not None else np.nan,
+            twist.linear.x if twist is not None else np.nan))
+
+    def cliff(self, msg):
+        self.append(LOG_CLIFF, (self.clock() - self.t0, msg.data[0], msg.data[1]))
+
+    def audio(self, data):
+        with self.lock:
+            if self.f is None:
+                return
+            self.samples.append(bytes(data))
+            self.append_locked(LOG_AUDIO, (self.clock() - self.t0, len(data)))
+
+    def append(self, stream, row):
+        with self.lock:
+            if self.f is not None:
+                self.append_locked(stream, row)
+
+    def append_locked(self, stream, row):
+        buf = self.buffers[stream]
+        buf[self.fill[stream]] = row
+        self.fill[stream] += 1
+        if self.fill[stream] == len(buf):
+            self.write_chunk(stream)
+
+    def write_chunk(self, stream):
+        n = self.fill[stream]
+        if n == 0:
+            return
+        rows = self.buffers[stream][:n]
+        raw = b"".join(np.ascontiguousarray(rows[name]).tobytes() for name in rows.dtype.names)
+        if stream == LOG_AUDIO:
+            raw += b"".join(self.samples)
+            self.samples = []
+        data = zlib.compress(raw, 1)
+        self.f.write(SENSOR_LOG_CHUNK.pack(stream, n, len(data), len(raw)))
+        self.f.write(data)
+        self.bytes_written += SENSOR_LOG_CHUNK.size + len(data)
+        self.fill[stream] = 0
+
+    def close(self):
+        with self.lock:
+            if self.f is None:
+                return
+            for stream in self.buffers:
+                self.write_chunk(stream)
+            self.f.close()
+            self.f = None
+
+class SensorLog:
+    """
+    reader for a SensorRecorder file; rows(stream) yields (row, samples)
+    in recording order, samples being the audio bytes of an audio row
+
+    sessions appended to one file play back to back: t of each session
+    continues from the end of the one before. `sessions` holds the
+    [wall-clock start, t offset] of each (start None for a file without
+    session markers). a recording that was cut off loses only its torn
+    last chunk.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.index = {s: [] for s in LOG_DTYPES}
+        self.sessions = []
+        with open(path, "rb") as f:
+            if f.read(len(SENSOR_LOG_MAGIC)) != SENSOR_LOG_MAGIC:
+                raise ValueError(f"{path} is not a sensor log")
+            for stream, n, size, raw_size, offset in sensor_log_chunks(f):
+                if stream == LOG_SESSION:
+                    f.seek(offset)
+                    self.sessions.append([SENSOR_LOG_SESSION.unpack(f.read(size))[0], 0.0])
+                    continue
+                if not self.sessions:
+                    self.sessions.append([None, 0.0])
+                self.index[stream].append((offset, n, size, raw_size, len(self.sessions) - 1))
+
+        # each session's t restarts at 0; its offset is where the one before
+        # ended. read while all offsets are still 0
+        ends = [0.0] * len(self.sessions)
+        for stream, index in self.index.items():
+            last = {chunk[4]: chunk for chunk in index}
+            for session, chunk in last.items():
+                for rows, _ in self.chunks(stream, [chunk]):
+                    ends[session] = max(ends[session], float(rows["t"][-1]))
+        offset = 0.0
+        for session, end in zip(self.sessions, ends):
+            session[1] = offset
+            offset += end
+
+    def chunks(self, stream, index=None):
+        dtype = LOG_DTYPES[stream]
+        with open(self.path, "rb") as f:
+            for offset, n, size, raw_size, session in self.index[stream] if index is None else index:
+                f.seek(offset)
+                raw = zlib.decompress(f.read(size))
+                rows = np.zeros(n, dtype)
+                pos = 0
+                for name in dtype.names:
+                    width = dtype[name].itemsize * n
+                    rows[name] = np.frombuffer(raw, dtype[name], n, pos)
+                    pos += width
+                rows["t"] += self.sessions[session][1]
+                yield rows, raw[pos:]
+
+    def rows(self, stream):
+        for rows, blob in self.chunks(stream):
+            pos = 0
+            for row in rows:
+                samples = None
+                if stream == LOG_AUDIO:
+                    samples = blob[pos:pos + int(row["n"])]
+                    pos += int(row["n"])
+                yield row, samples
+
+    def duration(self):
+        end = 0.0
+        for stream, index in self.index.items():
+            for rows, _ in self.chunks(stream, index[-1:]):
+                end = max(end, float(rows["t"][-1]))
+        return end
+
 class controller:
 
     # def callback_package(self, msg):
@@ -232,42 +2188,192 @@ class controller:
 
 
     def callback_package(self, msg):
-        # store for processing in update_gui
-        self.input_package = msg
+        if self.recorder is not None:
+            self.recorder.package(msg)
+        if self.tracer is not None:
+            self.package_stamp = self.tracer.stamp(msg)
+        if self.dispatch is not None:
+            self.dispatch(self.store_package, msg)
+            return
+        self.store_package(msg)
 
+    def store_package(self, msg):
+        # store for processing in update_gui
+        self.snapshot.update(package=msg, package_time=self.snapshot.clock())
+
+    def trace_event(self, kind, stamp, *pubs):
+        # the reaction published on pubs is traced back to this event
+        if self.tracer is not None:
+            self.tracer.attach(self.tracer.begin(kind, stamp), *pubs)
+
+    def untrace(self, *pubs):
+        if self.tracer is not None:
+            self.tracer.detach(*pubs)
+
+
+    def running(self):
+        return self.t_now < 1000.0 and not rospy.core.is_shutdown()
+
+    def startup_mark(self, stage):
+        self.startup[stage] = time.monotonic() - STARTUP_T0
+
+    def startup_step(self):
+        # before the frame opens, so the init pose goes out ahead of the tick's writes
+        if "first_tick" not in self.startup:
+            self.startup_mark("first_tick")
+        if self.init_pose_pending:
+            waiting = [pub for pub in self.init_pose_pubs if pub.get_num_connections() == 0]
+            if waiting and self.t_now < self.connect_timeout:
+                return
+            if waiting:
+                rospy.logwarn("no subscribers on %s, sending the init pose anyway",
+                              ", ".join(str(getattr(pub, "name", pub)) for pub in waiting))
+            self.ear_control("normal",0, 0.5)
+            self.tail_control("normal", 0, 0)
+            self.eye_control("open", 0, 0)
+            self.Spin(self.msg_spin, "stop", 0.25)
+            self.illum_Shine(0, False)
+            self.init_pose_pending = False
+            self.startup_mark("init_pose")
+        if self.Audio.loaded.is_set():
+            self.startup["kws_loaded"] = self.Audio.loaded_at - STARTUP_T0
+            self.startup_pending = False
+            self.report_startup()
+
+    def report_startup(self):
+        rospy.loginfo("startup [%s], ms since imports: %s (kws model load %.0f ms)", self.robot_name,
+                      ", ".join(f"{stage} {t * 1000:.0f}" for stage, t in
+                                sorted(self.startup.items(), key=lambda item: item[1])),
+                      (self.Audio.load_time or 0.0) * 1000)
+
+    def control_tick(self):
+        if self.startup_pending:
+            self.startup_step()
+
+        # collect actuator writes, one publish per topic at end of tick
+        self.frame.begin()
+
+        # one consistent copy of the sensor values for the whole tick
+        self.sensor_seq, values = self.snapshot.read()
+        self.Get_msg_package = values["package"]
+        self.sensors.load(values)
+        if values["package_time"] is not None:
+            self.package_age = self.snapshot.clock() - values["package_time"]
+            if self.package_age > self.max_package_age:
+                self.max_package_age = self.package_age
+            if self.package_age > self.stale_after:
+                self.stale_ticks += 1
+
+        # oscillators: one table lookup per tick instead of sin/cos calls
+        if self.f_kin != self.osc.f_kin or self.f_cos != self.osc.f_cos:
+            self.osc.set_frequency(self.f_kin, self.f_cos)
+        self.xk, self.osc_row = self.osc.sample()
+        self.xc, self.xcc, self.xc2 = self.osc_row
+
+        # subsystems due this tick, each at its own rate
+        self.executor.run(self.tick)
+
+        self.frame.flush(self.tick)
+
+    def advance_time(self, tick):
+        self.t_control_now = self.t_control_now + (tick - self.tick) * self.scheduler.period
+        self.osc.advance(tick - self.tick)
+        self.tick = tick
+        # derive time from the tick index so it never accumulates error
+        self.t_now = tick * self.scheduler.period
+
+    def publish_profile(self):
+        report = {"robot": self.robot_name, "tick": self.tick, "sensors": self.sensor_report(),
+                  "audio": self.Audio.audio_report(),
+                  "utilisation": {f"{rate:g}": round(load, 4)
+                                  for rate, load in sorted(self.executor.utilisation().items())}}
+        if self.profiler is not None:
+            report["budget_us"] = self.profiler.budget_us
+            report["stages"] = self.profiler.report()
+        if self.tracer is not None:
+            report.update(self.tracer.report())
+        report = json.dumps(report)
+        msg = String()
+        msg.data = report
+        self.pub_profile.publish(msg)
+        if self.profile_file:
+            tmp = self.profile_file + ".tmp"
+            try:
+                with open(tmp, "w") as f:
+                    f.write(report)
+                os.replace(tmp, self.profile_file)
+            except OSError as e:
+                rospy.logwarn(f"profile not written: {e}")
+
+    def start_log(self):
+        if LOG.thread is not None:
+            return
+        sinks = []
+        path = rospy.get_param("~log_file", "")
+        if path:
+            sinks.append(file_sink(path))
+        if rospy.get_param("~log_topic", False):
+            pub = rospy.Publisher("~log", String, queue_size=10)
+            def publish(lines):
+                msg = String()
+                msg.data = "\n".join(lines)
+                pub.publish(msg)
+            sinks.append(publish)
+        LOG.start(sinks or [print_sink], rospy.get_param("~log_flush", 0.5))
+
+    def sensor_report(self):
+        return {"seq": self.sensor_seq, "package_age": self.package_age,
+                "max_package_age": self.max_package_age, "stale_ticks": self.stale_ticks,
+                "read_retries": self.snapshot.retries}
+
+    def report_utilisation(self):
+        rospy.loginfo("rate utilisation: %s", ", ".join(
+            f"{rate:g} Hz {load:.1%}" for rate, load in sorted(self.executor.utilisation().items())))
+        rospy.loginfo("sensors: %s", self.sensor_report())
+        rospy.loginfo("audio: %s", self.Audio.audio_report())
+        if self.profiler is not None or self.tracer is not None:
+            self.publish_profile()
 
     def loop(self):
         # loop
-        while self.t_now < 1000.0 and not rospy.core.is_shutdown():
+        self.tick = self.scheduler.start()
+        while self.running():
+            self.control_tick()
 
-            self.Get_msg_package = self.input_package
-            self.xk = math.sin(self.t_now * self.f_kin * 2 * math.pi)
-            self.xc = math.sin(self.t_now * self.f_cos * 2 * math.pi)
-            self.xcc = math.cos(self.t_now * self.f_cos * 2 * math.pi)
-            self.xc2 = math.sin(self.t_now * self.f_cos * 1 * math.pi)
+            # state
+            self.advance_time(self.scheduler.wait())
 
-            if self.debug_avoidance:
-                self.update_avoidance_state()
-                self.avoidance_motion()
+        self.report_utilisation()
 
-            # self.Shake_heads(self.xk, "normal")
-            #self.duration_test()
-            #touch perception
-            self.BodyTouch_Flag, self.HeadTouch_Flag = self.Gain_Touch_flag(self.Get_msg_package)
-            # print(self.HeadTouch_Flag)
+    def safety_task(self):
+        if self.debug_avoidance:
+            self.update_avoidance_state()
+            self.avoidance_motion()
 
-            self.touch_feel(self.xk, self.xc, self.xc2, self.xcc)
+    def touch_task(self):
+        self.touch_loops = []
+        if self.Get_msg_package is None:
+            return
+        # self.Shake_heads(self.xk, "normal")
+        #self.duration_test()
+        #touch perception
+        self.BodyTouch_Flag, self.HeadTouch_Flag = self.Gain_Touch_flag(self.Get_msg_package)
+        # print(self.HeadTouch_Flag)
 
-            #self.happy_dance(self.xk, self.xc, self.xc2, self.xcc)
+        touched = self.HeadTouch_Flag > 0 or self.BodyTouch_Flag > 0
+        if touched != self.touched:
+            self.touched = touched
+            if touched:
+                self.trace_event("touch", self.package_stamp, self.pub_kin.pub, self.pub_cos.pub)
+            else:
+                self.untrace(self.pub_kin.pub, self.pub_cos.pub)
 
-            #self.Shake_heads(self.xk, "normal")
-            #self.debug()
-            self.audio_motion()
+        self.touch_feel(self.xk, self.xc, self.xc2, self.xcc)
 
-            # state
-            time.sleep(0.02)
-            self.t_now = self.t_now + 0.02
-            self.t_control_now = self.t_control_now + 0.02
+        #self.happy_dance(self.xk, self.xc, self.xc2, self.xcc)
+
+        #self.Shake_heads(self.xk, "normal")
+        #self.debug()
 
     def duration_test(self):
         if(self.duration_test_debug):
@@ -339,10 +2445,7 @@ class controller:
     def illum_Shine(self, xcc, shine_flag):
         if shine_flag == True:
             q = int(xcc * -127 + 128)
-            for i in range(0, 3):
-                self.msg_illum.data[i] = (q << ((2-i) * 8)) | 0xFF000000
-            for i in range(3, 6): 
-                self.msg_illum.data[i] = (q << ((i-3) * 8)) | 0xFF000000
+            self.msg_illum.data[:] = ILLUM_SHINE_WORDS[q]
         else:
             # 不闪烁时设为全黑（只有 alpha 通道）
             for i in range(6):
@@ -472,23 +2575,52 @@ class controller:
         self.illum_Shine(xcc, True)
         self.Spin(self.msg_spin, "dance_roll", 0.25)
 
+    def head_touch_reaction(self, xk, xc, xc2, xcc):
+        self.Shake_heads(xk, "bow_head")
+        self.tail_control("wag",xc, xc2)
+        self.ear_control("inverse", xc, 0.5)
+
+    def idle_pose(self, xk, xc, xc2, xcc):
+        self.Shake_heads(xk, "normal")
+        self.tail_control("normal",xc, xc2)
+        self.tail_control("normal",xc, xc2)
+
+    def body_touch_reaction(self, xk, xc, xc2, xcc):
+        self.illum_Shine(xcc, True)
+        self.tail_control("droop",xc, xc2)
+        self.ear_control("inverse", xc, 0.5)
+
+    def play_loop(self, name, behaviour):
+        # compiled once per oscillator setting, then one row lookup per tick.
+        # until then (or for a cycle too long to compile) run it directly.
+        # the loop's cosmetic and illum channels are played by their own
+        # slower tasks
+        timeline = self.timelines.loop(name, behaviour, self.osc)
+        if timeline is None:
+            behaviour(self.xk, self.xc, self.xc2, self.xcc)
+        else:
+            timeline.play_motion(self, self.osc.ticks)
+            self.touch_loops.append(timeline)
+
+    def cosmetic_task(self):
+        for timeline in self.touch_loops:
+            timeline.play_cos(self, self.osc.ticks)
+
+    def illum_task(self):
+        for timeline in self.touch_loops:
+            timeline.play_illum(self, self.osc.ticks)
+
     def touch_feel(self, xk, xc, xc2, xcc):
         self.BodyTouch_Flag, self.HeadTouch_Flag = self.Gain_Touch_flag(self.Get_msg_package)
         # touch head
         if self.HeadTouch_Flag > 0:
-            self.Shake_heads(xk, "bow_head")
-            self.tail_control("wag",xc, xc2)
-            self.ear_control("inverse", xc, 0.5)
+            self.play_loop("head_touch", self.head_touch_reaction)
         else:
-            self.Shake_heads(xk, "normal")
-            self.tail_control("normal",xc, xc2)
-            self.tail_control("normal",xc, xc2)
-        
+            self.play_loop("idle_pose", self.idle_pose)
+
         # touch body
         if self.BodyTouch_Flag > 0:
-            self.illum_Shine(xcc, True)
-            self.tail_control("droop",xc, xc2)
-            self.ear_control("inverse", xc, 0.5)
+            self.play_loop("body_touch", self.body_touch_reaction)
 
         # touch left body
         if (self.BodyTouch_Flag > 1000) & (self.BodyTouch_Flag < 16383):
@@ -515,137 +2647,106 @@ class controller:
                 self.right_touch = False
 
     def audio_judge(self, audio_judge_flag):
-        if audio_judge_flag == "hello":
-            self.audio_head_nod = True
-            self.emotion_controller.express_emotion_by_keyword("neutral")
-
-        if audio_judge_flag == "left":
-            self.audio_turn_left = True
-            self.emotion_controller.express_emotion_by_keyword("excited")
-        if audio_judge_flag == "right":
-            self.audio_turn_right = True
-            self.emotion_controller.express_emotion_by_keyword("excited")
-        if audio_judge_flag == "move":
-            self.audio_move_forward = True
-            self.emotion_controller.express_emotion_by_keyword("excited")
-        if audio_judge_flag =="back":
-            self.audio_back = True
-        if audio_judge_flag == "round":
-            self.audio_round = True
-            self.emotion_controller.express_emotion_by_keyword("happy")
-        if audio_judge_flag == "dance":
-            self.audio_dance = True
-            self.emotion_controller.express_emotion_by_keyword("happy")
-
-    def audio_motion(self):
-        if(self.audio_head_nod):
-            self.audio_head_time =  self.audio_head_time + 1
-            if self.audio_head_time < self.audio_head_duration:
-                self.debug_avoidance = False
-                self.Shake_heads(self.xk, "left_right_head")
-            else:
-                self.audio_head_time = 0
-                self.audio_head_nod = False
-                self.debug_avoidance = True
-                self.Shake_heads(self.xk, "normal")
-        if(self.audio_turn_left):
-            self.audio_left_time = self.audio_left_time + 1
-            if self.audio_left_time < self.audio_left_duration:
-                self.Spin(self.msg_spin, "spin_angles", 0.2)
-            else:
-                self.audio_left_time = 0
-                self.audio_turn_left = False
-                self.Spin(self.msg_spin, "stop", 0)
-        if(self.audio_turn_right):
-            self.audio_right_time = self.audio_right_time + 1
-            if self.audio_right_time < self.audio_right_duration:
-                self.Spin(self.msg_spin, "spin_angles", -0.2)
-            else:
-                self.audio_right_time = 0
-                self.audio_turn_right = False
-                self.Spin(self.msg_spin, "stop", 0)
-        if(self.audio_round):
-            self.audio_round_time = self.audio_round_time + 1
-            if self.audio_round_time < self.audio_round_duration:
-                self.Spin(self.msg_spin, "dance_roll", 1)
-            else:
-                self.audio_round_time = 0
-                self.audio_round = False
-                self.Spin(self.msg_spin, "stop", 0)
-        if(self.audio_move_forward):
-            self.audio_move_forward_time = self.audio_move_forward_time + 1
-            if self.audio_move_forward_time < self.audio_move_duration:
-                self.Wheel_Move_Straight_Forward(self.msg_wheels, "move", 0.4)
-            else:
-                self.audio_move_forward_time = 0
-                self.audio_move_forward = False
-                self.Wheel_Move_Straight_Forward(self.msg_wheels, "stop", -0.0)
-        if(self.audio_back):
-            self.back_time = self.back_time + 1
-            if self.back_time < self.back_duration:
-                self.Wheel_Move_Straight_Forward(self.msg_wheels, "move", -0.4)
-            else:
-                self.back_time = 0
-                self.audio_back = False
-                self.Wheel_Move_Straight_Forward(self.msg_wheels, "stop", -0.0)
-        if (self.audio_dance):
-            self.audio_dance_time = self.audio_dance_time + 1
-            if self.audio_dance_time < self.audio_dance_duration:
-                self.happy_dance(self.xk, self.xc, self.xc2, self.xcc)
-            else:
-                self.audio_dance_time = 0
-                self.audio_dance = False
-                self.happy_dance(0,0,0,0)
+        if audio_judge_flag not in self.audio_commands:
+            return
+        emotion, make_action = self.audio_commands[audio_judge_flag]
+        action = make_action()
+        action.on_complete = self.command_finished
+        action.on_cancel = self.command_cancelled
+        self.command_action = action
+        self.actions.request(action)
+        if emotion is not None:
+            self.emotion_controller.express_emotion_by_keyword(emotion)
+        return action
+
+    def audio_sequence(self, flags, after=None):
+        """
+        run audio commands one after another, return the action of the
+        first. with `after` (an action audio_judge returned) they wait for
+        it to finish if it is still the running command
+        """
+        with self.command_lock:
+            self.command_queue.clear()
+            self.command_queue.extend(flags)
+            if after is not None and after is self.command_action:
+                return None
+            return self.next_command()
+
+    def next_command(self):
+        with self.command_lock:
+            self.command_action = None
+            while self.command_queue:
+                action = self.audio_judge(self.command_queue.popleft())
+                if action is not None:
+                    return action
+        return None
+
+    def command_finished(self, action):
+        if action is self.command_action:
+            self.next_command()
+
+    def command_cancelled(self, action):
+        # pre-empted (avoidance), refused or withdrawn: the rest is dropped
+        with self.command_lock:
+            if action is self.command_action:
+                self.command_queue.clear()
+                self.command_action = None
+
+    def audio_withdraw(self, action):
+        # take back an action audio_judge() returned
+        if action is not None:
+            self.actions.withdraw(action)
+
+    def spin_action(self, name, duration, spin_mode, spin_numbers, priority=PRIORITY_COMMAND):
+        return TimedAction(name, duration,
+                           lambda: self.Spin(self.msg_spin, spin_mode, spin_numbers),
+                           lambda: self.Spin(self.msg_spin, "stop", 0),
+                           priority=priority)
+
+    def drive_action(self, name, duration, speed, priority=PRIORITY_COMMAND):
+        return TimedAction(name, duration,
+                           lambda: self.Wheel_Move_Straight_Forward(self.msg_wheels, "move", speed),
+                           lambda: self.Wheel_Move_Straight_Forward(self.msg_wheels, "stop", -0.0),
+                           priority=priority)
+
+    def head_nod_action(self):
+        def step():
+            self.debug_avoidance = False
+            self.Shake_heads(self.xk, "left_right_head")
+        def finish():
+            self.debug_avoidance = True
+            self.Shake_heads(self.xk, "normal")
+        return TimedAction("hello", self.audio_head_duration, step, finish,
+                           resources=("head",), priority=PRIORITY_COMMAND)
+
+    def dance_action(self):
+        return TimedAction("dance", self.audio_dance_duration, self.dance_step,
+                           lambda: self.happy_dance(0, 0, 0, 0),
+                           resources=("head", "cosmetic", "illum", "wheels"),
+                           priority=PRIORITY_COMMAND)
+
+    def dance_step(self):
+        # one row of the routine compiled at the current frequencies, like
+        # the touch loops; played directly while a retuned one compiles
+        timeline = self.timelines.loop("happy_dance", self.happy_dance, self.osc)
+        if timeline is None:
+            self.happy_dance(self.xk, self.xc, self.xc2, self.xcc)
+        else:
+            timeline.play(self, self.osc.ticks)
+
     def Judge_detection(self):
         if self.detection_flag == "move":
-            self.detection_move = True
+            self.actions.request(self.drive_action(
+                "detection_move", self.detection_move_duration, 0.4))
         if self.detection_flag == "stop":
-            self.detection_stop = True
+            # one-tick action: pre-empts the other commands on the wheels and stops
+            self.actions.request(self.spin_action("detection_stop", 1, "stop", 0.0))
         if self.detection_flag == "clockwise":
-            self.detection_clockwise = True
+            self.actions.request(self.spin_action(
+                "detection_clockwise", self.detection_clockwise_duration, "spin_angles", 0.2))
         if self.detection_flag == "counterclockwise":
-            self.detection_counterclockwise = True
-    
-    def detection_motion(self):
-        if(self.detection_move):
-            self.detection_move_time = self.detection_move_time + 1
-            if self.detection_move_time < self.detection_move_duration:
-                self.Wheel_Move_Straight_Forward(self.msg_wheels, "move", 0.4)
-            else:
-                self.detection_move_time  = 0
-                self.detection_move = False
-                self.Wheel_Move_Straight_Forward(self.msg_wheels, "stop", -0.0)
-
-        if(self.detection_clockwise):
-            self.detection_counterclockwise = False
-            self.detection_clockwise_time = self.detection_clockwise_time + 1
-            if self.detection_clockwise_time < self.detection_clockwise_duration:
-                self.Spin(self.msg_spin, "spin_angles", 0.2)
-            else:
-                self.detection_clockwise_time = 0
-                self.detection_clockwise = False
-                self.Spin(self.msg_spin, "stop", 0.0)
-
-        if(self.detection_counterclockwise):
-            self.detection_clockwise = False
-            self.detection_counterclockwise_time = self.detection_counterclockwise_time + 1
-            if self.detection_counterclockwise_time < self.detection_counterclockwise_duration:
-                self.Spin(self.msg_spin, "spin_angles", -0.2)
-            else:
-                self.detection_counterclockwise_time = 0
-                self.detection_counterclockwise = False
-                self.Spin(self.msg_spin, "stop", 0.0)
-
-        if(self.detection_stop):
-            self.Spin(self.msg_spin, "stop", 0.0)
-            self.Wheel_Move_Straight_Forward(self.msg_wheels, "stop", -0.0)
-            self.detection_clockwise = False
-            self.detection_counterclockwise = False
-            self.detection_move = False
-            i = 0
-            while i < 5:
-                self.detection_stop = False
-                i += 1
+            self.actions.request(self.spin_action(
+                "detection_counterclockwise", self.detection_counterclockwise_duration, "spin_angles", -0.2))
 
     def update_avoidance_state(self):
         safe_dist = 0.25
@@ -658,120 +2759,179 @@ class controller:
         self.sensors.detect_cliff()
         self.cliff_flag = self.sensors.cliff_flag
         dist = self.sensors.get_sonar_distance()
-        # if dist is None:
-        #     return
+        # no sonar reading yet, the loop starts before the first package
+        if dist is None:
+            dist = float("inf")
 
         if self.cliff_flag == "right":
             self.avoidance_turn_right = True
-            print(self.cliff_flag)
+            LOG.log(SITE_AVOID, self.cliff_flag)
         elif self.cliff_flag == "left":
             self.avoidance_turn_left = True
-            print(self.cliff_flag)
+            LOG.log(SITE_AVOID, self.cliff_flag)
         elif self.cliff_flag == "inverse":
             self.avoidance_inverse = True
-            print(self.cliff_flag)
+            LOG.log(SITE_AVOID, self.cliff_flag)
         # print(self.cliff_flag)
         # elif self.cliff_flag == "cliff_safe":
         if ((dist <= safe_dist) & (self.dist)):
-            print("sonar")
+            LOG.log(SITE_SONAR)
+            self.trace_event("sonar", self.sensors.sonar_stamp, self.pub_wheels.pub)
             self.Wheel_Move_Straight_Forward(self.msg_wheels, "stop", -0.0)
             self.dist = False
             self.avoidance_turn_back = True
-        
-        self.avoidance_time = 0  
 
-    def avoidance_motion(self):
-        if self.avoidance_turn_left:
-            while(self.avoidance_time < self.avoidance_duration):
-                self.avoidance_time += 1
-                self.Spin(self.msg_spin, "spin_angles", 2)  # 左转90°
+    def yaw_rate(self):
+        # measured body yaw rate, if the sensors package carries odometry
+        odom = getattr(self.Get_msg_package, "odom", None)
+        if odom is None:
+            return None
+        return odom.twist.twist.angular.z
+
+    def avoidance_action(self, kind):
+        dt = self.scheduler.period
+        if kind == "turn_left":
+            action = self.spin_action(kind, self.avoidance_duration, "spin_angles", 2, PRIORITY_CLIFF)  # 左转90°
+            action.until = TurnedThrough(self.yaw_rate, dt, np.radians(90.0))
+        elif kind == "turn_right":
+            action = self.spin_action(kind, self.avoidance_duration, "spin_angles", -2, PRIORITY_CLIFF)  # 右转90°
+            action.until = TurnedThrough(self.yaw_rate, dt, np.radians(90.0))
+        elif kind == "inverse":
+            action = TimedAction(kind, self.avoidance_duration,
+                                 lambda: self.Wheel_Move_Straight_Forward(self.msg_spin, "move", -2),
+                                 lambda: self.Spin(self.msg_spin, "stop", 0),
+                                 priority=PRIORITY_CLIFF)
+        else:
+            action = self.spin_action(kind, self.avoidance_turn_back_duration, "spin_angles", 0.5, PRIORITY_SONAR)
+            action.until = TurnedThrough(self.yaw_rate, dt, np.radians(180.0))
+            spin = action.step
+
+            # hold the sonar stop for the first tick, the spin would overwrite
+            # it in the same frame and the stop would never reach the wheels
+            def step():
+                if action.ticks == 1:
+                    self.Wheel_Move_Straight_Forward(self.msg_wheels, "stop", -0.0)
+                else:
+                    spin()
+            action.step = step
+        action.on_complete = self.avoidance_done
+        return action
+
+    def avoidance_done(self, action):
+        # the trigger stays pending until its manoeuvre completes, so a
+        # pre-empted sonar turn-back restarts once the cliff reaction is over
+        if action.name == "turn_left":
             self.avoidance_turn_left = False
-            self.Spin(self.msg_spin, "stop", 0)
-            
-            self.avoidance_time  = 0
-
-        elif self.avoidance_turn_right:
-            while(self.avoidance_time < self.avoidance_duration):
-                self.avoidance_time += 1
-                self.Spin(self.msg_spin, "spin_angles", -2)  # 右转90°
+        elif action.name == "turn_right":
             self.avoidance_turn_right = False
-            self.Spin(self.msg_spin, "stop", 0)
-            self.avoidance_time  = 0
+        elif action.name == "inverse":
+            self.avoidance_inverse = False
+        elif action.name == "turn_back":
+            self.avoidance_turn_back = False
+            self.dist = True
+        self.untrace(self.pub_wheels.pub)
 
+    def avoidance_motion(self):
+        # pending reaction with the highest priority, cliffs before sonar
+        if self.avoidance_turn_left:
+            kind = "turn_left"
+        elif self.avoidance_turn_right:
+            kind = "turn_right"
         elif self.avoidance_inverse:
-            while(self.avoidance_time < self.avoidance_duration):
-                self.avoidance_time += 1
-                self.Wheel_Move_Straight_Forward(self.msg_spin, "move", -2)  
-            self.avoidance_inverse = False
-            self.Spin(self.msg_spin, "stop", 0)
-            self.avoidance_time  = 0   
+            kind = "inverse"
+        elif self.avoidance_turn_back:
+            kind = "turn_back"
+        else:
+            return
 
-        if self.avoidance_turn_back:
-            while(self.avoidance_time < 80 * self.avoidance_duration):
-                self.avoidance_time += 1
-                self.Spin(self.msg_spin, "spin_angles", 0.5)  
-            self.avoidance_turn_back = False
-            self.audio_turn_left = False
-            self.audio_left_time = 0
-            self.audio_turn_right = False
-            self.audio_right_time = 0
-            self.audio_round = False
-            self.audio_round_time = 0
-            self.Spin(self.msg_spin, "stop", 0)
-            self.avoidance_time  = 0  
-            self.dist = True 
-
-    def __init__(self, args):
+        # starting pre-empts the voice commands and, for a cliff, a running turn-back
+        if not self.actions.is_active(kind):
+            # a turn-back was traced when the sonar stop was sent
+            if kind != "turn_back":
+                self.trace_event("cliff", self.sensors.cliff_stamp, self.pub_wheels.pub)
+            self.actions.start(self.avoidance_action(kind))
+
+    def __init__(self, args, robot_name=None, fleet=None):
+
+        # startup stage -> seconds since STARTUP_T0
+        self.startup = {}
+        self.startup_mark("init_start")
+
+        # topic namespace, defaults to $MIRO_ROBOT_NAME
+        self.robot_name = robot_name or os.getenv("MIRO_ROBOT_NAME")
+
+        # --async: run on one asyncio event loop (AsyncRuntime) instead of threads
+        self.use_async = "--async" in args
+
+        # hot-path log lines are flushed from LOG to ~log_file, the ~log
+        # topic, or stdout when neither is set
+        self.start_log()
+
+        # see MiroSensors.dispatch
+        self.dispatch = None
+
+        # see LatencyTracer, set up with the publishers when ~trace is on
+        self.tracer = None
+        self.package_stamp = None
+        self.touched = False
+
+        # ~record: log the sensor and microphone streams for replay (miro_sim),
+        # "{robot}" in the path is replaced by the robot name
+        self.recorder = None
+        record = rospy.get_param("~record", "")
+        if record:
+            self.recorder = SensorRecorder(record.format(robot=self.robot_name))
+
+        # timed actions (voice commands, detection, avoidance), stepped once per tick
+        self.actions = ActionEngine()
 
         #audio parameters
-        self.Audio = OfflineKeywordListener(self)
-        self.audio_thread = threading.Thread(target=self.Audio.run)
-        self.audio_thread.daemon = True  
-        self.audio_thread.start()
+        # a fleet shares one listener (microphone and vosk model) between robots
+        if fleet is not None:
+            self.Audio = fleet.listener
+        else:
+            self.Audio = OfflineKeywordListener(self)
+        # a shared microphone is recorded in the first robot's log
+        if self.Audio.recorder is None:
+            self.Audio.recorder = self.recorder
+        if fleet is None and not self.use_async:
+            self.audio_thread = threading.Thread(target=self.Audio.run)
+            self.audio_thread.daemon = True
+            self.audio_thread.start()
 
-        self.audio_head_nod = False
-        self.audio_head_time = 0
         self.audio_head_duration = 200
-
-        self.audio_turn_left = False
-        self.audio_left_time = 0
         self.audio_left_duration = 30
-
-        self.audio_turn_right = False
-        self.audio_right_time = 0
         self.audio_right_duration = 30
-
-        self.audio_round = False
-        self.audio_round_time = 0
         self.audio_round_duration = 30
-
-        self.audio_move_forward = False
-        self.audio_move_forward_time = 0
         self.audio_move_duration = 60
-
-        self.audio_back = False
-        self.back_time = 0
         self.back_duration = 60
-
-        self.audio_dance = False
-        self.audio_dance_time = 0
         self.audio_dance_duration = 300
 
+        # voice command -> (emotion, action factory)
+        self.audio_commands = {
+            "hello": ("neutral", self.head_nod_action),
+            "left": ("excited", lambda: self.spin_action(
+                "left", self.audio_left_duration, "spin_angles", 0.2)),
+            "right": ("excited", lambda: self.spin_action(
+                "right", self.audio_right_duration, "spin_angles", -0.2)),
+            "move": ("excited", lambda: self.drive_action(
+                "move", self.audio_move_duration, 0.4)),
+            "back": (None, lambda: self.drive_action(
+                "back", self.back_duration, -0.4)),
+            "round": ("happy", lambda: self.spin_action(
+                "round", self.audio_round_duration, "dance_roll", 1)),
+            "dance": ("happy", self.dance_action),
+        }
+
+        # audio_sequence(): commands waiting for the running one to finish
+        self.command_queue = deque()
+        self.command_action = None
+        self.command_lock = threading.RLock()
+
         #detection parameters
         self.detection_flag = None
-
-        self.detection_move = False
-        self.detection_move_time = 0
         self.detection_move_duration = 60
-                
-        self.detection_stop = False
-
-        self.detection_clockwise = False
-        self.detection_clockwise_time = 0
         self.detection_clockwise_duration = 60
-
-        self.detection_counterclockwise = False
-        self.detection_counterclockwise_time = 0
         self.detection_counterclockwise_duration = 60
 
         #sin cos curve
@@ -783,11 +2943,30 @@ class controller:
         #time parameters
         self.t_now = 0.0
         self.t_control_now = 0.0
+        self.tick = 0
+
+        # 50 Hz loop on absolute deadlines, overrun policy "skip" or "catchup"
+        if fleet is not None:
+            self.scheduler = fleet.scheduler
+        else:
+            self.scheduler = DeadlineScheduler(
+                period=0.02,
+                policy=rospy.get_param("~overrun_policy", "skip"),
+            )
 
         # state
         self.vbat = 0
         self.Get_msg_package = None
 
+        # latest sensor values, written by the callbacks and read once per tick;
+        # a package older than ~stale_after seconds counts the tick as stale
+        self.snapshot = SensorSnapshot()
+        self.sensor_seq = 0
+        self.package_age = None
+        self.max_package_age = 0.0
+        self.stale_after = rospy.get_param("~stale_after", 0.1)
+        self.stale_ticks = 0
+
         #Get Touch sensors
         self.BodyTouch_Flag = []
         self.HeadTouch_Flag = []
@@ -807,6 +2986,8 @@ class controller:
         self.illum = False	
         self.f_kin = 0.25
         self.f_cos = 1.0
+        self.osc = OscillatorBank(self.scheduler.period, self.f_kin, self.f_cos)
+        self.osc_row = None
 
         self.duration_test_debug = True
         self.durtion_debug_time = 0
@@ -816,14 +2997,16 @@ class controller:
 
         self.debug_avoidance = True
 
-        self.sensors = MiroSensors()
+        self.sensors = MiroSensors(self.robot_name, self.snapshot)
+        self.sensors.recorder = self.recorder
         self.avoidance_turn_left = False
         self.avoidance_turn_right = False
         self.avoidance_turn_back = False
         self.avoidance_inverse = False
 
-        self.avoidance_time = 0
+        # manoeuvre lengths in ticks, run as timed actions
         self.avoidance_duration = 60  # 可调节，比如前进持续 50 次主循环
+        self.avoidance_turn_back_duration = 2 * self.avoidance_duration
 
         self.dist = True
 
@@ -864,12 +3047,20 @@ class controller:
         
         self.touch_time = 0
 
+        # actuator writes of one tick are flushed together
+        self.frame = OutputFrame()
+
+        # unchanged actuator payloads are only resent on this keepalive period
+        self.heartbeat = rospy.get_param("~heartbeat", 0.5)
+
         # robot name
-        topic_base_name = "/" + os.getenv("MIRO_ROBOT_NAME")
+        topic_base_name = "/" + self.robot_name
         # publish
         topic = topic_base_name + "/control/cmd_vel"
         print ("publish", topic)
-        self.pub_wheels = rospy.Publisher(topic, geometry_msgs.msg.TwistStamped, queue_size=0)
+        self.pub_wheels = FramedPublisher(self.frame, ChangeSuppressedPublisher(
+            rospy.Publisher(topic, geometry_msgs.msg.TwistStamped, queue_size=0),
+            twist_payload, self.heartbeat))
 
         # subscribe
         topic = topic_base_name + "/sensors/package"
@@ -880,21 +3071,27 @@ class controller:
         # publish
         topic = topic_base_name + "/control/illum"
         print ("publish", topic)
-        self.pub_illum = rospy.Publisher(topic, UInt32MultiArray, queue_size=0)
+        self.pub_illum = FramedPublisher(self.frame, ChangeSuppressedPublisher(
+            rospy.Publisher(topic, UInt32MultiArray, queue_size=0),
+            array_payload, self.heartbeat))
 
         topic = topic_base_name + "/core/mpg/push"
         print ("publish", topic)
-        self.pub_push = rospy.Publisher(topic, miro.msg.push, queue_size=0)
+        self.pub_push = FramedPublisher(self.frame, rospy.Publisher(topic, miro.msg.push, queue_size=0))
 
         # publish
         topic = topic_base_name + "/control/kinematic_joints"
         print ("publish", topic)
-        self.pub_kin = rospy.Publisher(topic, JointState, queue_size=0)
+        self.pub_kin = FramedPublisher(self.frame, ChangeSuppressedPublisher(
+            rospy.Publisher(topic, JointState, queue_size=0),
+            joint_payload, self.heartbeat))
 
         # publish
         topic = topic_base_name + "/control/cosmetic_joints"
         print ("publish", topic)
-        self.pub_cos = rospy.Publisher(topic, Float32MultiArray, queue_size=0)
+        self.pub_cos = FramedPublisher(self.frame, ChangeSuppressedPublisher(
+            rospy.Publisher(topic, Float32MultiArray, queue_size=0),
+            array_payload, self.heartbeat))
 
         topic = topic_base_name + "/core/animal/state"
         print("publish", topic)
@@ -902,27 +3099,227 @@ class controller:
 
         self.emotion_controller = EmotionController(self.pub_animal_state)
 
-        #initial state
+        # behaviours compiled to per-tick actuator tables, cached on disk between runs
+        cache_dir = rospy.get_param("~timeline_cache", os.path.expanduser("~/.cache/miro_timelines"))
+        self.timelines = TimelineCompiler(self, cache_dir)
+        # the dance and touch loops at the starting frequencies, so the tick never waits
+        for name, behaviour in (("happy_dance", self.happy_dance),
+                                ("head_touch", self.head_touch_reaction),
+                                ("idle_pose", self.idle_pose),
+                                ("body_touch", self.body_touch_reaction)):
+            self.timelines.loop(name, behaviour, self.osc, wait=True)
+
+        # subsystem rates as divisors of the 50 Hz tick: safety and timed
+        # actions every tick, cosmetic joints 25 Hz, illum 12.5 Hz, emotion 2.5 Hz
+        self.executor = MultiRateExecutor(self.scheduler.period)
+        self.touch_loops = []
+        self.executor.add("safety", self.safety_task, 1)
+        self.executor.add("touch", self.touch_task, 1)
+        # the touch loops' cosmetic and illum channels, on the ticks those
+        # topics are flushed; before actions so a running action still wins
+        self.executor.add("cosmetic", self.cosmetic_task, 2, offset=0)
+        self.executor.add("illum", self.illum_task, 4, offset=0)
+        self.executor.add("actions", self.actions.step, 1)
+        self.executor.add("emotion", self.emotion_controller.update, 20)
+        # actions and avoidance still write these every tick, only every
+        # 2nd / 4th tick's last write is published
+        self.frame.set_divisor(self.pub_cos.pub, 2)
+        self.frame.set_divisor(self.pub_illum.pub, 4)
+
+        # ~profile: time each stage of the tick, ~trace: link actuator
+        # publishes to the sensor events behind them. either is reported as
+        # JSON on a topic and/or in ~profile_file every 2 s
+        self.profiler = None
+        if rospy.get_param("~profile", False):
+            self.profiler = StageProfiler(self.scheduler.period)
+            self.profiler.instrument(self)
+        if rospy.get_param("~trace", False):
+            self.tracer = LatencyTracer()
+            self.sensors.tracer = self.tracer
+            self.frame.tracer = self.tracer
+        if self.profiler is not None or self.tracer is not None:
+            topic = topic_base_name + "/controller/profile"
+            print ("publish", topic)
+            self.pub_profile = rospy.Publisher(topic, String, queue_size=1)
+            self.profile_file = rospy.get_param("~profile_file", "")
+            self.executor.add("profile", self.publish_profile, 100)
 
-        
-        i = 0
-        while i < 50:
-            self.ear_control("normal",0, 0.5)
-            self.tail_control("normal", 0, 0)
-            #self.Shake_heads(self.xk, "normal")
-            self.eye_control("open", 0, 0)
-            self.Spin(self.msg_spin, "stop", 0.25)
-            self.illum_Shine(0, False) 
-            i += 1
+        #initial state
+        # sent by startup_step() once the actuator topics have subscribers,
+        # or after ~connect_timeout seconds without them
+        self.init_pose_pending = True
+        self.init_pose_pubs = (self.pub_wheels, self.pub_illum, self.pub_kin, self.pub_cos)
+        self.connect_timeout = rospy.get_param("~connect_timeout", 2.0)
+        self.startup_pending = True
 
         self.emotion_controller.express_emotion_by_keyword("neutral")
+        self.startup_mark("init")
+
+class AsyncRuntime:
+    """
+    runs a controller on one asyncio event loop
+
+    the control tick, sensor intake and keyword decoding are coroutines on
+    the same loop, so sensor messages are applied between ticks rather than
+    from rospy threads in the middle of one. vosk decoding, which blocks,
+    runs on a single worker thread through run_in_executor.
+    """
+
+    def __init__(self, ctrl):
+        self.ctrl = ctrl
+        self.loop = None
+        self.sensor_queue = None
+        self.audio_queue = None
+        self.decoder = ThreadPoolExecutor(max_workers=1, thread_name_prefix="kws")
+
+    def run(self):
+        try:
+            asyncio.run(self.main())
+        finally:
+            self.decoder.shutdown(wait=False)
+
+    async def main(self):
+        self.loop = asyncio.get_running_loop()
+        self.sensor_queue = asyncio.Queue()
+        self.audio_queue = asyncio.Queue(maxsize=16)
+
+        # rospy and portaudio callbacks only post into the loop from here on
+        self.ctrl.dispatch = self.post_sensor
+        self.ctrl.sensors.dispatch = self.post_sensor
+
+        # only used while decoding inline: from the start, or once the
+        # listener falls back from a lost kws server
+        listener = self.ctrl.Audio
+        listener.on_block = self.post_audio
+        tasks = [asyncio.create_task(self.sensor_intake()),
+                 asyncio.create_task(self.keywords(listener))]
+        try:
+            await self.control()
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            self.ctrl.dispatch = None
+            self.ctrl.sensors.dispatch = None
+            listener.on_block = None
+
+    def post_sensor(self, handler, msg):
+        # called on rospy threads
+        self.loop.call_soon_threadsafe(self.sensor_queue.put_nowait, (handler, msg))
+
+    def post_audio(self, data):
+        # called on the portaudio thread
+        self.loop.call_soon_threadsafe(self.offer_audio, data)
+
+    def offer_audio(self, data):
+        # drop the oldest block rather than let decoding fall further behind
+        if self.audio_queue.full():
+            self.audio_queue.get_nowait()
+        self.audio_queue.put_nowait(data)
+
+    async def control(self):
+        ctrl = self.ctrl
+        ctrl.tick = ctrl.scheduler.start()
+        while ctrl.running():
+            ctrl.control_tick()
+            tick, delay = ctrl.scheduler.next()
+            # always yield, so intake and decoding get the loop between ticks
+            await asyncio.sleep(max(delay, 0.0))
+            ctrl.advance_time(tick)
+        ctrl.report_utilisation()
+
+    async def sensor_intake(self):
+        while True:
+            handler, msg = await self.sensor_queue.get()
+            handler(msg)
+
+    async def keywords(self, listener):
+        await self.loop.run_in_executor(self.decoder, listener.load)
+        with listener.stream:
+            while listener.results is not None:
+                # decoding happens elsewhere, only wait for its results here
+                text = await self.loop.run_in_executor(self.decoder, listener.next_text)
+                if text is not None:
+                    listener.handle_text(text)
+            while True:
+                data = await self.audio_queue.get()
+                text = await self.loop.run_in_executor(self.decoder, listener.decode, data)
+                if text is not None:
+                    listener.handle_text(text)
+
+class Fleet:
+    """
+    several robots driven from one process
+
+    each robot gets its own controller, with its own topics, sensor state,
+    action engine and executor. the scheduler, the microphone and vosk
+    model, the oscillator tables and the compiled timelines are shared, so
+    an extra robot only adds its controller state. a recognised keyword is
+    sent to every robot.
+    """
+
+    def __init__(self, names, args):
+        self.scheduler = DeadlineScheduler(
+            period=0.02,
+            policy=rospy.get_param("~overrun_policy", "skip"),
+        )
+        self.listener = OfflineKeywordListener(self)
+        self.robots = [controller(args, name, fleet=self) for name in names]
 
-        # wait for connect
-        print ("wait for connect...")
-        time.sleep(1)
+        self.audio_thread = threading.Thread(target=self.listener.run)
+        self.audio_thread.daemon = True
+        self.audio_thread.start()
+
+    def audio_judge(self, flag):
+        return [robot.audio_judge(flag) for robot in self.robots]
+
+    def audio_sequence(self, flags, after=None):
+        after = after or [None] * len(self.robots)
+        return [robot.audio_sequence(flags, a) for robot, a in zip(self.robots, after)]
+
+    def audio_withdraw(self, actions):
+        for robot, action in zip(self.robots, actions):
+            robot.audio_withdraw(action)
+
+    def loop(self):
+        tick = self.scheduler.start()
+        for robot in self.robots:
+            robot.tick = tick
+        robots = [robot for robot in self.robots if robot.running()]
+        while robots:
+            for robot in robots:
+                robot.control_tick()
+            tick = self.scheduler.wait()
+            for robot in robots:
+                robot.advance_time(tick)
+            robots = [robot for robot in robots if robot.running()]
+
+        for robot in self.robots:
+            rospy.loginfo("[%s]", robot.robot_name)
+            robot.report_utilisation()
+        rospy.loginfo("fleet scheduler: %s", self.scheduler.stats())
+
+def fleet_names(spec):
+    """
+    "miro01,miro02" or a robot count, N gives $MIRO_ROBOT_NAME01 .. N
+    """
+    if spec.isdigit():
+        prefix = os.getenv("MIRO_ROBOT_NAME") or "miro"
+        return [f"{prefix}{i:02d}" for i in range(1, int(spec) + 1)]
+    return [name.strip() for name in spec.split(",") if name.strip()]
 
 if __name__ == "__main__":
 
+    # --fleet NAMES|N: drive several robots from this process
+    args = sys.argv[1:]
+    if "--fleet" in args:
+        i = args.index("--fleet")
+        Fleet(fleet_names(args[i + 1]), args[:i] + args[i + 2:]).loop()
+        sys.exit(0)
+
     # normal singular invocation
     main = controller(sys.argv[1:])
-    main.loop()
+    if main.use_async:
+        AsyncRuntime(main).run()
+    else:
+        main.loop()
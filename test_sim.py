@@ -0,0 +1,445 @@
+#!/usr/bin/env python3
+#
+# tests for test5.0.py, run headless through miro_sim
+#
+#   python3 -m pytest -q test_sim.py
+
+import threading
+
+import numpy as np
+import pytest
+
+from miro_sim import Simulation
+
+
+@pytest.fixture(scope="module")
+def m():
+    # the controller script, loaded once for the tests of its plain classes
+    return Simulation().load()
+
+def sim_controller(params=None):
+    sim = Simulation(params)
+    ctrl = sim.load().controller([])
+    return sim, ctrl
+
+def fake_clock():
+    now = [0.0]
+    def sleep(delay):
+        now[0] += delay
+    return now, (lambda: now[0]), sleep
+
+
+################################################################
+# scheduler
+
+def test_scheduler_skips_missed_ticks(m):
+    now, clock, sleep = fake_clock()
+    scheduler = m.DeadlineScheduler(0.02, "skip", clock=clock, sleep=sleep)
+    assert scheduler.start() == 0
+    now[0] = 0.075
+    tick, delay = scheduler.next()
+    assert tick == 4
+    assert delay == pytest.approx(0.005)
+    assert scheduler.skipped_ticks == 3
+    assert scheduler.overruns == 1
+    assert scheduler.max_lateness == pytest.approx(0.055)
+
+def test_scheduler_catches_up(m):
+    now, clock, sleep = fake_clock()
+    scheduler = m.DeadlineScheduler(0.02, "catchup", clock=clock, sleep=sleep)
+    scheduler.start()
+    now[0] = 0.075
+    assert [scheduler.next() for _ in range(3)] == [(1, 0.0), (2, 0.0), (3, 0.0)]
+    tick, delay = scheduler.next()
+    assert tick == 4
+    assert delay == pytest.approx(0.005)
+    assert scheduler.skipped_ticks == 0
+
+def test_scheduler_waits_on_time(m):
+    now, clock, sleep = fake_clock()
+    scheduler = m.DeadlineScheduler(0.02, "skip", clock=clock, sleep=sleep)
+    scheduler.start()
+    assert [scheduler.wait() for _ in range(5)] == [1, 2, 3, 4, 5]
+    assert now[0] == pytest.approx(0.1)
+    assert scheduler.overruns == 0
+
+def test_scheduler_policy(m):
+    with pytest.raises(ValueError):
+        m.DeadlineScheduler(policy="later")
+
+
+################################################################
+# sensor snapshot
+
+def test_snapshot_keeps_other_fields(m):
+    snapshot = m.SensorSnapshot(clock=lambda: 1.0)
+    snapshot.update(sonar_distance=0.5)
+    snapshot.update(cliff_left=0.9, cliff_right=0.8)
+    seq, values = snapshot.read()
+    assert seq == 2
+    assert values["sonar_distance"] == 0.5
+    assert (values["cliff_left"], values["cliff_right"]) == (0.9, 0.8)
+
+def test_snapshot_retries_a_torn_read(m):
+    snapshot = m.SensorSnapshot()
+    snapshot.update(sonar_distance=0.5)
+
+    class Flipping(dict):
+        # a write lands while the reader copies the front slot
+        def copy(self):
+            snapshot.slots[snapshot.seq & 1] = dict(self)
+            snapshot.update(sonar_distance=0.25)
+            return dict(self)
+
+    snapshot.slots[snapshot.seq & 1] = Flipping(snapshot.slots[snapshot.seq & 1])
+    seq, values = snapshot.read()
+    assert snapshot.retries == 1
+    assert (seq, values["sonar_distance"]) == (2, 0.25)
+
+def test_snapshot_reads_are_consistent(m):
+    snapshot = m.SensorSnapshot()
+    snapshot.update(cliff_left=0, cliff_right=0)
+    stop = threading.Event()
+
+    def writer():
+        i = 0
+        while not stop.is_set():
+            i += 1
+            snapshot.update(cliff_left=i, cliff_right=i)
+
+    thread = threading.Thread(target=writer)
+    thread.start()
+    try:
+        for _ in range(20000):
+            _, values = snapshot.read()
+            assert values["cliff_left"] == values["cliff_right"]
+    finally:
+        stop.set()
+        thread.join()
+
+
+################################################################
+# ring log
+
+def test_ringlog_reports_lost_entries(m):
+    now, clock, _ = fake_clock()
+    log = m.RingLog(size=4, clock=clock)
+    site = log.site("x", "%d")
+    for i in range(10):
+        log.log(site, i)
+    lines = log.drain()
+    assert [line.split("x: ")[1] for line in lines[:-1]] == ["6", "7", "8", "9"]
+    assert "6 messages lost" in lines[-1]
+    assert log.drain() == []
+    log.log(site, 10)
+    assert [line.split("x: ")[1] for line in log.drain()] == ["10"]
+
+def test_ringlog_reports_suppressed_once(m):
+    now, clock, _ = fake_clock()
+    log = m.RingLog(size=8, clock=clock)
+    site = log.site("x", "%d", rate=1.0)
+    for i in range(5):
+        log.log(site, i)
+    lines = log.drain()
+    assert len(lines) == 2
+    assert "4 messages over the rate limit" in lines[1]
+    assert log.drain() == []
+    log.log(site, 5)
+    log.log(site, 6)
+    assert ["2 messages over the rate limit" in line for line in log.drain()] == [True]
+    now[0] = 1.0
+    log.log(site, 7)
+    assert log.drain()[0].endswith("x: 7")
+
+
+################################################################
+# keywords
+
+def test_keyword_matcher(m):
+    matcher = m.KeywordMatcher({"move": "forward", "go": "forward", "move back": "back",
+                                "turn left": "left", "left": "left", "dance": "dance"})
+    assert matcher.commands("move back then dance") == ["back", "dance"]
+    assert matcher.commands("go and turn left") == ["forward", "left"]
+    assert matcher.commands("move move") == ["forward", "forward"]
+    assert matcher.commands("remove the leftover") == []
+    assert matcher.commands("move") == ["forward"]
+    assert matcher.commands("") == []
+
+def test_controller_keywords():
+    sim, ctrl = sim_controller()
+    matcher = ctrl.Audio.matcher
+    assert matcher.commands("left then dance") == ["left", "dance"]
+    assert matcher.commands("leftover") == []
+
+
+################################################################
+# latency histogram
+
+def test_histogram_buckets(m):
+    hist = m.LatencyHistogram
+    values = list(range(2000)) + [int(v) for v in np.geomspace(2000, 2 ** 30, 2000)]
+    for v in values:
+        i = hist.index(v)
+        assert hist.upper(i) >= v
+        assert i == 0 or hist.upper(i - 1) < v
+        assert hist.upper(i) - v <= v / 32
+    assert hist.index(2 ** 62) == hist.SIZE - 1
+
+def test_histogram_percentiles(m):
+    hist = m.LatencyHistogram()
+    for us in range(1, 1001):
+        hist.record(us)
+    assert hist.percentile(0.5) == pytest.approx(500, rel=0.04)
+    assert hist.percentile(1.0) == 1000
+    assert hist.summary()["n"] == 1000
+
+
+################################################################
+# sensor recording
+
+class Cliff:
+    def __init__(self, left, right):
+        self.data = [left, right]
+
+def record(m, path, session):
+    now = [0.0]
+    recorder = m.SensorRecorder(path, chunk_rows=4, audio_rows=2, clock=lambda: now[0])
+    for i in range(10):
+        now[0] = i * 0.1
+        recorder.cliff(Cliff(session, i))
+        recorder.audio(bytes([i]) * 4)
+    recorder.close()
+
+def test_recorder_round_trip(m, tmp_path):
+    path = str(tmp_path / "sensors.log")
+    for session in range(2):
+        record(m, path, session)
+
+    log = m.SensorLog(path)
+    assert len(log.sessions) == 2
+    assert log.sessions[1][1] == pytest.approx(0.9)
+    rows = [row for row, _ in log.rows(m.LOG_CLIFF)]
+    assert [(row["left"], row["right"]) for row in rows] == [(s, i) for s in range(2) for i in range(10)]
+    times = [float(row["t"]) for row in rows]
+    assert times == sorted(times)
+    assert log.duration() == pytest.approx(1.8)
+    audio = list(log.rows(m.LOG_AUDIO))
+    assert [samples for _, samples in audio] == [bytes([i]) * 4 for i in range(10)] * 2
+    assert all(row["n"] == 4 for row, _ in audio)
+
+    # cut off mid-chunk: the last cliff chunk (rows 8 and 9) is torn
+    with open(path, "r+b") as f:
+        f.truncate(f.seek(0, 2) - 3)
+    log = m.SensorLog(path)
+    assert len(list(log.rows(m.LOG_CLIFF))) == 18
+    # the next recording drops the torn tail before it appends
+    record(m, path, 2)
+    log = m.SensorLog(path)
+    assert len(log.sessions) == 3
+    rows = [row for row, _ in log.rows(m.LOG_CLIFF)]
+    assert [(row["left"], row["right"]) for row in rows] == (
+        [(0, i) for i in range(10)] + [(1, i) for i in range(8)] + [(2, i) for i in range(10)])
+    times = [float(row["t"]) for row in rows]
+    assert times == sorted(times)
+    assert len(list(log.rows(m.LOG_AUDIO))) == 30
+
+    # a session appended straight after a torn chunk is found again by its marker
+    with open(path, "rb") as f:
+        data = f.read()
+    start = data.index(m.SENSOR_LOG_MARK, len(m.SENSOR_LOG_MARK) + 8)
+    with open(path, "wb") as f:
+        f.write(data[:start - 3] + data[start:])
+    log = m.SensorLog(path)
+    assert len(log.sessions) == 3
+    assert len(list(log.rows(m.LOG_CLIFF))) == 26
+
+
+################################################################
+# voice gate
+
+BLOCK = 1600
+
+def harmonic(n):
+    t = np.arange(n) / 16000.0
+    tone = sum(np.sin(2 * np.pi * f * t) / k for k, f in enumerate((180, 360, 540, 720), 1))
+    return (tone * 4000).astype(np.int16).tobytes()
+
+def test_gate_skips_silence_and_noise(m):
+    gate = m.VoiceGate()
+    noise = (np.random.default_rng(0).standard_normal(BLOCK * 5) * 3000).astype(np.int16)
+    for i in range(5):
+        assert gate.process(bytes(BLOCK * 2)) == ()
+        assert gate.process(noise[i * BLOCK:(i + 1) * BLOCK].tobytes()) == ()
+    assert gate.openings == 0
+
+def test_gate_passes_voice_with_pre_roll_and_hangover(m):
+    gate = m.VoiceGate()
+    silence = bytes(BLOCK * 2)
+    for _ in range(5):
+        gate.process(silence)
+    voice = harmonic(BLOCK)
+    # 0.3 s of pre-roll comes out ahead of the block that opened the gate
+    assert gate.process(voice) == [silence] * 3 + [voice]
+    # open for 0.8 s of silence after
+    assert [len(gate.process(silence)) for _ in range(10)] == [1] * 8 + [0] * 2
+    assert gate.openings == 1
+
+
+def test_gate_without_pre_roll(m):
+    gate = m.VoiceGate(pre_roll=0)
+    silence = bytes(BLOCK * 2)
+    for _ in range(5):
+        assert gate.process(silence) == ()
+    voice = harmonic(BLOCK)
+    assert gate.process(voice) == [voice]
+
+
+################################################################
+# controller on the simulated robot
+
+def test_sim_rates():
+    sim, ctrl = sim_controller()
+    sim.set(touch_head=1, touch_body=500)
+    sim.run(ctrl, 400)
+    counts = sim.publish_counts()
+    # the touch loops change cosmetic joints and illum on every flush
+    assert 150 < counts["/miro/control/cosmetic_joints"] <= 201
+    assert 75 < counts["/miro/control/illum"] <= 101
+    assert sorted(ctrl.executor.utilisation()) == [2.5, 12.5, 25.0, 50.0]
+    assert ctrl.scheduler.stats()["skipped_ticks"] == 0
+
+def test_runs_on_the_sim_clock():
+    sim, ctrl = sim_controller()
+    start = sim.clock.now
+    sim.after(1.0, sonar=0.1)
+    sim.run(ctrl, 100)
+    assert sim.clock.now - start == pytest.approx(2.0, abs=0.02)
+    assert ctrl.scheduler.stats()["skipped_ticks"] == 0
+    assert sim.publish_counts()["/miro/control/kinematic_joints"] > 0
+    # the sonar obstacle reached the controller and it backed off
+    assert ctrl.actions.active or ctrl.actions.completed
+
+def test_voice_command():
+    sim, ctrl = sim_controller()
+    sim.run(ctrl, 20)
+    sim.say("dance")
+    seen = set()
+    for _ in range(300):
+        sim.run(ctrl, 1)
+        seen.update(action.name for action in ctrl.actions.active)
+    assert "dance" in seen
+
+def test_sonar_stop_reaches_the_wheels():
+    sim, ctrl = sim_controller()
+    sim.run(ctrl, 20)
+    sim.say("move")
+    sim.run(ctrl, 50)
+    wheels = [pub for pub in sim.publishers if pub.name == "/miro/control/cmd_vel"][0]
+    assert wheels.last.twist.linear.x > 0.0
+    sim.set(sonar=0.1)
+    sent = []
+    for _ in range(20):
+        count = wheels.count
+        sim.run(ctrl, 1)
+        if wheels.count > count:
+            twist = wheels.last.twist
+            sent.append((twist.linear.x, twist.angular.z))
+    # the stop goes out on its own frame before the turn-back spin
+    sent = [twist for twist in sent if twist != (0.4, 0.0)]
+    assert sent[0] == (0.0, 0.0)
+    assert sent[1][1] != 0.0
+    assert ctrl.actions.is_active("turn_back")
+
+def test_decode_thread_only_without_on_block():
+    sim = Simulation({"~kws_decode_thread": True})
+    listener = sim.load().controller([]).Audio
+    listener.loaded.wait(10.0)
+    assert listener.decode_thread is not None
+    # under --async the runtime sets on_block before it loads the listener
+    sim = Simulation({"~kws_decode_thread": True})
+    listener = sim.load().controller(["--async"]).Audio
+    listener.on_block = lambda data: None
+    listener.load()
+    assert listener.decode_thread is None
+    assert listener.capture is None
+
+def test_fast_mode_withdraws_a_misheard_keyword():
+    sim, ctrl = sim_controller({"~kws_fast": True})
+    sim.run(ctrl, 50)
+    # the partials say "left", the final text does not
+    sim.say("hello", heard="left")
+    seen = set()
+    for _ in range(100):
+        sim.run(ctrl, 1)
+        seen.update(action.name for action in ctrl.actions.active)
+    assert "left" in seen
+    assert ctrl.actions.cancelled == 1
+    assert "left" not in [action.name for action in ctrl.actions.active]
+
+def test_fast_mode_waits_for_a_longer_phrase():
+    sim, ctrl = sim_controller({"~kws_fast": True})
+    sim.run(ctrl, 50)
+    # the partials say "move" before "move back"
+    sim.say("move back")
+    seen = set()
+    for _ in range(100):
+        sim.run(ctrl, 1)
+        seen.update(action.name for action in ctrl.actions.active)
+    assert "move" not in seen
+    assert "back" in seen
+    assert ctrl.actions.cancelled == 0
+
+def test_frequency_change_compiles_off_the_tick(m):
+    sim, ctrl = sim_controller()
+    compiler = type(ctrl.timelines)
+    compile = compiler.compile
+    threads = []
+
+    def recording(self, *args):
+        threads.append(threading.current_thread())
+        return compile(self, *args)
+
+    sim.set(touch_head=1)
+    sim.run(ctrl, 50)
+    compiler.compile = recording
+    try:
+        for f in (0.2501, 0.3):
+            ctrl.f_kin, ctrl.f_cos = f, f * 2
+            sim.run(ctrl, 20)
+            for future in list(compiler.pending.values()):
+                future.result()
+            assert ctrl.timelines.loop("head_touch", ctrl.head_touch_reaction, ctrl.osc) is not None
+    finally:
+        compiler.compile = compile
+    assert threads
+    assert threading.main_thread() not in threads
+    assert ctrl.scheduler.stats()["skipped_ticks"] == 0
+
+def test_timeline_cache_is_bounded(m):
+    sim, ctrl = sim_controller()
+    compiler = type(ctrl.timelines)
+    sim.set(touch_head=1, touch_body=500)
+    for i in range(12):
+        ctrl.f_kin, ctrl.f_cos = 0.2 + i * 0.05, 0.4 + i * 0.1
+        sim.run(ctrl, 2)
+        # the pool runs one job at a time, so this waits for the compiles
+        # and their done callbacks
+        compiler.pool.submit(lambda: None).result()
+    assert len(compiler.cache) <= compiler.MAX_TIMELINES
+    assert compiler.pending == {}
+    assert ctrl.timelines.loop("head_touch", ctrl.head_touch_reaction, ctrl.osc) is not None
+
+def test_dance_follows_retuned_frequencies(m):
+    sim, ctrl = sim_controller()
+    compiler = type(ctrl.timelines)
+    sim.run(ctrl, 20)
+    ctrl.f_kin, ctrl.f_cos = 0.3, 0.6
+    sim.say("dance")
+    danced = 0
+    for _ in range(300):
+        sim.run(ctrl, 1)
+        danced += any(action.name == "dance" for action in ctrl.actions.active)
+    compiler.pool.submit(lambda: None).result()
+    assert danced
+    # the dance was looked up at the new frequencies, not the startup ones
+    assert any(key[:2] == ("loop", "happy_dance") and key[3:5] == (0.3, 0.6) for key in compiler.cache)